@@ -0,0 +1,131 @@
+import os
+import time
+import importlib
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from flat_params import flat_buffer, flat_views
+from metrics_sink import log, STEP
+
+# Out-of-band test evaluation: worker processes hold their own learner and adapt it to the test
+# tasks from a snapshot of the meta weights, while the training loop goes on. A snapshot is either
+# a copy into one of a few preallocated shared memory buffers, or a checkpoint file.
+
+_worker = {}
+
+
+def _init_worker(args, test, slots, num_threads):
+    """
+    Build the learner of a worker process once, the meta weights are loaded for every evaluation
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    _worker['learner'] = importlib.import_module(args.learner).Learner(args)
+    _worker['test'] = test
+    _worker['slots'] = slots
+
+
+def _evaluate(global_step, slot = None, path = None):
+    """
+    Test accuracy of the meta weights in shared memory slot (or checkpoint path), with the test seed
+    of main.test_accuracy; seeding only touches the RNGs of this worker.
+    """
+    from main import random_seed
+    learner = _worker['learner']
+    params = list(learner.model.parameters())
+    with torch.no_grad():
+        if path is not None:
+            learner.model.load_state_dict(torch.load(path, map_location='cpu'))
+            os.remove(path)
+        else:
+            for param, snapshot in zip(params, flat_views(_worker['slots'][slot], params)):
+                param.copy_(snapshot)
+
+    random_seed(123)
+    test = _worker['test']
+    acc_all_test = [learner([test[i]], training = False) for i in range(len(test))]
+    return global_step, torch.stack(acc_all_test).mean().item()
+
+
+class AsyncEvaluator(object):
+    """
+    Pool of num_workers evaluation processes (spawned, so they work with CUDA too).
+
+    submit() snapshots the meta weights and returns at once; when all snapshot buffers are still in
+    use by earlier evaluations the request is dropped rather than waiting. poll() returns the
+    finished (global step, test accuracy, elapsed seconds at snapshot) results, close() waits for the rest.
+    """
+    def __init__(self, args, test, model, num_workers = 1, snapshot = 'shm', snapshot_dir = None, num_threads = 0):
+        """
+        :param test: MetaTask of the test tasks
+        :param model: meta model, whose parameters are snapshotted
+        :param snapshot: 'shm' (shared memory buffers) or 'checkpoint' (state_dict files in snapshot_dir)
+        :param num_threads: torch threads of every worker, 0 for the torch default
+        """
+        self.snapshot = snapshot
+        self.snapshot_dir = snapshot_dir or '.'
+        self.params = list(model.parameters())
+        self.model = model
+        # one buffer per running evaluation, plus one queued
+        num_slots = num_workers + 1
+        if snapshot == 'shm':
+            self.slots = [flat_buffer(self.params, device='cpu').share_memory_() for _ in range(num_slots)]
+        else:
+            self.slots = [None] * num_slots
+        self.slot_futures = [None] * num_slots
+        self.pending = []
+        self.pool = ProcessPoolExecutor(max_workers = num_workers, mp_context = mp.get_context('spawn'),
+                                        initializer = _init_worker,
+                                        initargs = (args, test, self.slots if snapshot == 'shm' else None, num_threads))
+
+    def submit(self, global_step, elapsed = None):
+        """
+        :return: False when the evaluation was dropped because every snapshot buffer is busy
+        """
+        free = [i for i, future in enumerate(self.slot_futures) if future is None or future.done()]
+        if not free:
+            return False
+        slot = free[0]
+        with torch.no_grad():
+            if self.snapshot == 'shm':
+                for snapshot, param in zip(flat_views(self.slots[slot], self.params), self.params):
+                    snapshot.copy_(param)
+                future = self.pool.submit(_evaluate, global_step, slot = slot)
+            else:
+                os.makedirs(self.snapshot_dir, exist_ok = True)
+                path = os.path.join(self.snapshot_dir, 'eval_snapshot_{}.pt'.format(global_step))
+                torch.save(self.model.state_dict(), path)
+                future = self.pool.submit(_evaluate, global_step, path = path)
+        self.slot_futures[slot] = future
+        self.pending.append((future, global_step, elapsed))
+        return True
+
+    def poll(self):
+        """
+        :return: list of (global step, test accuracy, elapsed) of the evaluations finished since the last call,
+                 failed evaluations are logged and left out
+        """
+        # one pass, a future finishing meanwhile is either done or still pending
+        done, pending = [], []
+        for entry in self.pending:
+            (done if entry[0].done() else pending).append(entry)
+        self.pending = pending
+
+        results = []
+        for future, global_step, elapsed in done:
+            try:
+                results.append(future.result() + (elapsed,))
+            except Exception as error:
+                log(STEP, 'test_failed', global_step = global_step, error = repr(error))
+        return sorted(results)
+
+    def close(self):
+        """
+        Wait for the submitted evaluations and shut the workers down.
+        :return: results not returned by poll() yet
+        """
+        while self.pending and not all(future.done() for future, _, _ in self.pending):
+            time.sleep(0.1)
+        results = self.poll()
+        self.pool.shutdown()
+        return results
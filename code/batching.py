@@ -0,0 +1,69 @@
+import torch
+from torch.utils.data import Sampler, DataLoader, RandomSampler
+
+
+def sequence_lengths(dataset):
+    """
+    Number of real (non padding) tokens of every example of a
+    TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)
+    """
+    return dataset.tensors[1].sum(1)
+
+
+def trim_batch(batch):
+    """
+    Trim input_ids, attention_mask and segment_ids of a batch to its longest sequence.
+
+    Padded positions are masked out of attention and never used by the classifier (it reads [CLS]),
+    so the model output is the same as for the fixed-padding batch. Call it on the CPU batch,
+    before moving it to the device, so it does not force a device sync.
+    """
+    input_ids, attention_mask, segment_ids, label_id = batch
+    max_len = int(attention_mask.sum(1).max())
+    return input_ids[:, :max_len], attention_mask[:, :max_len], segment_ids[:, :max_len], label_id
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping examples of similar length, so that trimmed batches carry little padding.
+
+    Examples are shuffled, sorted by length within buckets of bucket_size examples, cut into
+    batches, and the order of the batches is shuffled again.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=None):
+        """
+        :param lengths: tensor of sequence lengths, one per example
+        :param batch_size: number of examples per batch
+        :param shuffle: randomize bucket content and batch order
+        :param bucket_size: examples sorted together, None to sort the whole dataset (support sets are small)
+        """
+        self.lengths     = torch.as_tensor(lengths)
+        self.batch_size  = batch_size
+        self.shuffle     = shuffle
+        self.bucket_size = bucket_size or len(self.lengths)
+
+    def __iter__(self):
+        n = len(self.lengths)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        batches = []
+        for start in range(0, n, self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[torch.argsort(self.lengths[bucket], descending=True)]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        n, bucket = len(self.lengths), self.bucket_size
+        full, rest = divmod(n, bucket)
+        return full * -(-bucket // self.batch_size) + -(-rest // self.batch_size)
+
+
+def support_dataloader(support, batch_size, length_bucketing=False):
+    """
+    DataLoader over a support set, batched randomly or by length.
+    """
+    if length_bucketing:
+        return DataLoader(support, batch_sampler=LengthBucketSampler(sequence_lengths(support), batch_size))
+    return DataLoader(support, sampler=RandomSampler(support), batch_size=batch_size)
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import importlib
+import contextlib
+import resource
+import subprocess
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import TensorDataset
+
+# Offline throughput benchmark of the learners on synthetic tasks and randomly initialized BERTs.
+#
+# Every point of the grid (learner x config x k_spt x inner_batch_size x inner_update_step x seq_len)
+# runs in a fresh process, so that its peak RSS is its own, and reports tasks/sec, inner steps/sec and
+# outer step latency percentiles after warmup. Results are saved as JSON; --compare reports the
+# change of every point against an earlier result file and exits with 1 on a throughput regression.
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --output bench_new.json --compare bench.json
+
+CONFIGS = {
+    'tiny':  dict(hidden_size=32,  num_hidden_layers=2, num_attention_heads=2, intermediate_size=64),
+    'mini':  dict(hidden_size=256, num_hidden_layers=4, num_attention_heads=4, intermediate_size=1024),
+    'small': dict(hidden_size=512, num_hidden_layers=4, num_attention_heads=8, intermediate_size=2048),
+}
+VOCAB_SIZE = 1000
+GRID = ['learner', 'config', 'k_spt', 'inner_batch_size', 'inner_update_step', 'seq_len']
+
+
+def build_model(config_name, directory, num_labels = 2):
+    """
+    Save a randomly initialized BertForSequenceClassification of CONFIGS[config_name] into directory,
+    loadable with from_pretrained (and fast_startup.load_pretrained)
+    """
+    from transformers import BertConfig, BertForSequenceClassification
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=VOCAB_SIZE, max_position_embeddings=512, num_labels=num_labels,
+                        **CONFIGS[config_name])
+    BertForSequenceClassification(config).save_pretrained(directory)
+    return directory
+
+
+def synthetic_set(num_examples, seq_len, shape, generator):
+    """
+    TensorDataset(input_ids, attention_mask, segment_ids, label_ids) shaped like create_feature_set output:
+    reviews (one segment) or GLUE sentence pairs, lengths uniform in [seq_len / 4, seq_len], binary labels
+    """
+    lengths = torch.randint(max(seq_len // 4, 3), seq_len + 1, (num_examples,), generator=generator)
+    positions = torch.arange(seq_len)[None, :]
+    attention_mask = (positions < lengths[:, None]).long()
+    input_ids = torch.randint(4, VOCAB_SIZE, (num_examples, seq_len), generator=generator) * attention_mask
+    input_ids[:, 0] = 2  # [CLS]
+    input_ids[torch.arange(num_examples), lengths - 1] = 3  # [SEP]
+    segment_ids = torch.zeros_like(input_ids)
+    if shape == 'glue':
+        second = lengths // 2
+        segment_ids = ((positions >= second[:, None]) & (attention_mask == 1)).long()
+        input_ids[torch.arange(num_examples), second - 1] = 3
+    label_ids = torch.randint(0, 2, (num_examples,), generator=generator)
+    return TensorDataset(input_ids, attention_mask, segment_ids, label_ids)
+
+
+def synthetic_tasks(num_task, k_support, k_query, seq_len, shape, seed):
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return [(synthetic_set(k_support, seq_len, shape, generator), synthetic_set(k_query, seq_len, shape, generator))
+            for _ in range(num_task)]
+
+
+def learner_args(point, bench_args, model_dir, extra):
+    """
+    Arguments of a meta learner: the defaults of main.py, overridden by the grid point and extra flags
+    """
+    from main import get_parser
+    return get_parser().parse_args(['--bert_model', model_dir, '--learner', point['learner'],
+                                    '--k_spt', str(point['k_spt']), '--k_qry', str(bench_args.k_qry),
+                                    '--outer_batch_size', str(bench_args.outer_batch_size),
+                                    '--inner_batch_size', str(point['inner_batch_size']),
+                                    '--inner_update_step', str(point['inner_update_step'])] + extra)
+
+
+def run_point(point, bench_args, model_dir, extra):
+    """
+    Benchmark one grid point (in its own process)
+    """
+    torch.manual_seed(0)
+    if bench_args.threads > 0:
+        torch.set_num_threads(bench_args.threads)
+    num_steps = bench_args.warmup + bench_args.steps
+    batch_size = bench_args.outer_batch_size
+    tasks = synthetic_tasks(num_steps * batch_size, point['k_spt'], bench_args.k_qry, point['seq_len'],
+                            bench_args.task_shape, seed=0)
+    batches_per_epoch = -(-point['k_spt'] // point['inner_batch_size'])
+
+    if point['learner'] == 'baseline':
+        from bert_baseline import Bert_trainer
+        trainer = Bert_trainer(Namespace(num_labels=2, batch_size=point['inner_batch_size'], update_lr=5e-5,
+                                         bf16='--bf16' in extra, bert_model=model_dir, weights_cache=None))
+        device = trainer.device
+
+        def outer_step(task_batch):
+            # the baseline trains on the support set of each task for inner_update_step epochs
+            for support, _ in task_batch:
+                for _ in range(point['inner_update_step']):
+                    trainer(support)
+            return len(task_batch) * point['inner_update_step']
+    else:
+        learner = importlib.import_module(point['learner']).Learner(learner_args(point, bench_args, model_dir, extra))
+        device = learner.device
+
+        def outer_step(task_batch):
+            learner(task_batch)
+            return sum(getattr(learner, 'inner_steps_used', [point['inner_update_step']] * len(task_batch)))
+
+    latencies, inner_steps = [], 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for step in range(num_steps):
+            task_batch = tasks[step * batch_size:(step + 1) * batch_size]
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            inner_epochs = outer_step(task_batch)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            if step >= bench_args.warmup:
+                latencies.append(time.perf_counter() - start)
+                inner_steps += inner_epochs * batches_per_epoch
+
+    total = sum(latencies)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist()
+    return dict(point, tasks_per_sec=len(latencies) * batch_size / total, inner_steps_per_sec=inner_steps / total,
+                latency_p50=p50, latency_p90=p90, latency_p99=p99,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import transformers
+    return {'commit': commit, 'torch': torch.__version__, 'transformers': transformers.__version__,
+            'python': platform.python_version(), 'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+            'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+            'num_threads': torch.get_num_threads()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the tasks/sec ratio of every point of results also in baseline.
+    :return: number of points slower than baseline by more than tolerance
+    """
+    key = lambda row: tuple(row[name] for name in GRID)
+    previous = {key(row): row for row in baseline['results']}
+    regressions = 0
+    for row in results:
+        if key(row) not in previous:
+            continue
+        old = previous[key(row)]
+        ratio = row['tasks_per_sec'] / old['tasks_per_sec']
+        regressed = ratio < 1 - tolerance
+        regressions += regressed
+        print('{:<60} tasks/sec {:9.3f} -> {:9.3f} ({:+.1%})  p50 {:.4f} -> {:.4f}  rss {:.0f} -> {:.0f} MB{}'.format(
+              ' '.join('{}={}'.format(name, row[name]) for name in GRID), old['tasks_per_sec'], row['tasks_per_sec'],
+              ratio - 1, old['latency_p50'], row['latency_p50'], old['peak_rss_mb'], row['peak_rss_mb'],
+              '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Throughput benchmark of the learners on synthetic tasks; '
+                                                   'unknown arguments are passed to the meta learners (e.g. --bf16)')
+    parser.add_argument("--learners", default='maml,reptile', type=str,
+                        help="Comma separated learners among maml, reptile, maml_functional and baseline (bert_baseline.Bert_trainer)")
+    parser.add_argument("--configs", default='tiny,mini', type=str, help="Comma separated BERT sizes among " + ', '.join(CONFIGS))
+    parser.add_argument("--k_spt", default='16', type=str, help="Comma separated support set sizes")
+    parser.add_argument("--inner_batch_size", default='8', type=str, help="Comma separated inner batch sizes")
+    parser.add_argument("--inner_update_step", default='2', type=str, help="Comma separated numbers of inner epochs")
+    parser.add_argument("--seq_len", default='64,128', type=str, help="Comma separated sequence lengths")
+    parser.add_argument("--k_qry", default=8, type=int, help="Query set size")
+    parser.add_argument("--outer_batch_size", default=2, type=int, help="Tasks per outer step")
+    parser.add_argument("--task_shape", default='review', type=str, choices=['review', 'glue'],
+                        help="Single segment reviews or GLUE sentence pairs")
+    parser.add_argument("--warmup", default=1, type=int, help="Outer steps run before measuring")
+    parser.add_argument("--steps", default=5, type=int, help="Outer steps measured")
+    parser.add_argument("--threads", default=0, type=int, help="Torch threads, 0 for the torch default")
+    parser.add_argument("--output", default='benchmark.json', type=str, help="Result file")
+    parser.add_argument("--compare", default=None, type=str, help="Earlier result file to compare with")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="Relative tasks/sec drop reported as a regression by --compare")
+    bench_args, extra = parser.parse_known_args()
+
+    values = {'learner': bench_args.learners.split(','), 'config': bench_args.configs.split(',')}
+    for name in ['k_spt', 'inner_batch_size', 'inner_update_step', 'seq_len']:
+        values[name] = [int(value) for value in getattr(bench_args, name).split(',')]
+    points = [dict(zip(GRID, combination)) for combination in itertools.product(*[values[name] for name in GRID])]
+
+    model_root = tempfile.mkdtemp(prefix='benchmark_models_')
+    results = []
+    try:
+        model_dirs = {name: build_model(name, os.path.join(model_root, name)) for name in values['config']}
+        for point in points:
+            # a fresh process per point: isolated peak RSS, no state shared between points
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+                result = pool.submit(run_point, point, bench_args, model_dirs[point['config']], extra).result()
+            results.append(result)
+            print(' '.join('{}={}'.format(name, point[name]) for name in GRID),
+                  'tasks/sec {:.3f} inner steps/sec {:.2f} latency p50 {:.4f} p90 {:.4f} p99 {:.4f} peak RSS {:.0f} MB'.format(
+                  result['tasks_per_sec'], result['inner_steps_per_sec'], result['latency_p50'], result['latency_p90'],
+                  result['latency_p99'], result['peak_rss_mb']))
+    finally:
+        shutil.rmtree(model_root, ignore_errors=True)
+
+    settings = {name: getattr(bench_args, name) for name in ['k_qry', 'outer_batch_size', 'task_shape', 'warmup', 'steps', 'threads']}
+    settings['extra'] = extra
+    with open(bench_args.output, 'w') as f:
+        json.dump({'environment': environment(), 'settings': settings, 'results': results}, f, indent=1)
+    print('Saved', len(results), 'results to', bench_args.output)
+
+    if bench_args.compare is not None:
+        with open(bench_args.compare) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            print('Warning: the settings differ from', bench_args.compare, baseline['settings'])
+        regressions = compare(results, baseline, bench_args.tolerance)
+        if regressions:
+            print(regressions, 'regressions')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
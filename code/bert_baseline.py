@@ -3,7 +3,6 @@ import torch
 from torch.utils.data import Dataset
 import numpy as np
 import random
-from transformers import BertModel, BertTokenizer
 from torch.utils.data import TensorDataset
 from transformers import glue_processors as processors
 from transformers import glue_output_modes as output_modes
@@ -14,12 +13,18 @@ from torch.nn import functional as F
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler
 from torch.optim import Adam
 from torch.nn import CrossEntropyLoss
-from transformers import BertForSequenceClassification
 from copy import deepcopy
 import gc
-from sklearn.metrics import accuracy_score
 import torch
 import argparse
+import time
+from precision import autocast
+from metrics import StreamingMetrics, primary_metric
+from fast_startup import load_pretrained, load_tokenizer
+from checkpoint import CheckpointWriter, list_checkpoints, latest_checkpoint, save_training_state, load_training_state
+from metrics_sink import sink, log, STEP, TASK, INNER, FORMATS
+
+logger = logging.getLogger(__name__)
 
 class BertTask_Baseline(Dataset):
     ''' 
@@ -129,18 +134,21 @@ class Bert_trainer(nn.Module):
         self.num_labels = args.num_labels
         self.batch_size = args.batch_size
         self.update_lr  = args.update_lr
+        self.bf16       = args.bf16
     
 
         self.bert_model = args.bert_model
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         
-        self.model = BertForSequenceClassification.from_pretrained(self.bert_model, num_labels = self.num_labels)
+        self.model = load_pretrained(self.bert_model, self.num_labels, args.weights_cache)
         self.outer_optimizer = Adam(self.model.parameters(), lr=self.update_lr)
         self.model.train()
 
     def forward(self, datasets,training=True):
         """
         batch_tasks = TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)
+
+        In evaluation returns the dict of GLUE metrics of the task of datasets (see metrics.py)
         """
 
         num_task = len(datasets)
@@ -151,38 +159,33 @@ class Bert_trainer(nn.Module):
         if training:
             dataloader = DataLoader(datasets,batch_size=self.batch_size)
             for data in dataloader:
-                all_loss = []
                 batch = tuple(t.to(self.device) for t in data)
                 input_ids, attention_mask, segment_ids, label_id = batch
-                outputs = self.model(input_ids, attention_mask, segment_ids, labels = label_id)
+                with autocast(self.device, self.bf16):
+                    outputs = self.model(input_ids, attention_mask, segment_ids, labels = label_id)
                 loss = outputs[0]              
                 loss.backward()
                 self.outer_optimizer.step()
                 self.outer_optimizer.zero_grad()
-                all_loss.append(loss.item())
+                log(INNER, 'train_loss', loss = loss)
             self.model.to(torch.device('cpu'))
             return outputs
         else:
             
             with torch.no_grad():
-                correct = 0
-                total = 0
+                # official metric of the GLUE task, accumulated on the device over all batches
+                metrics = StreamingMetrics(getattr(datasets, 'task', None), self.num_labels, self.device)
                 self.model.to(torch.device(self.device))
                 dataloader = DataLoader(datasets,batch_size=self.batch_size)
                 for data in dataloader:
                     
-                    query_batch = iter(dataloader).next()
-                    query_batch = tuple(t.to(self.device) for t in query_batch)
+                    query_batch = tuple(t.to(self.device) for t in data)
                     q_input_ids, q_attention_mask, q_segment_ids, q_label_id = query_batch
-                    q_outputs = self.model(q_input_ids, q_attention_mask, q_segment_ids, labels = q_label_id)
+                    with autocast(self.device, self.bf16):
+                        q_outputs = self.model(q_input_ids, q_attention_mask, q_segment_ids, labels = q_label_id)
                 
-                    q_logits = F.softmax(q_outputs[1],dim=1)
-                    pre_label_id = torch.argmax(q_logits,dim=1)
-                    # pre_label_id = pre_label_id.detach().cpu().numpy().tolist()
-                    # label_id = q_label_id.detach().cpu().numpy().tolist()
-                    total += q_label_id.size(0)
-                    correct += pre_label_id.eq(q_label_id.to(self.device).view_as(pre_label_id)).sum().item()
-                acc = correct/total
+                    metrics.update(q_outputs[1], q_label_id)
+                acc = metrics.compute()
                 self.model.to(torch.device('cpu'))
         return acc
 
@@ -215,43 +218,83 @@ def main():
                         help="Number of Samples for each evaling task. None for the whole data set")
     parser.add_argument("--update_lr", default=5e-5, type=float, help="The initial learning rate for Adam.")
     parser.add_argument("--epochs", default=3, type=int, help="The epochs trained for each task.")
+    parser.add_argument("--bf16", action="store_true",
+                        help="bfloat16 autocast of the forward passes (fp32 weights)")
+    parser.add_argument("--bf16_compare", action="store_true",
+                        help="With --bf16, repeat every evaluation in fp32 to report the accuracy delta and speedup of bf16")
     parser.add_argument("--output_dir",default="bert_models&results",type=str,help="The output folder.")
+    parser.add_argument("--weights_cache", default=None, type=str,
+                        help="Directory caching the pretrained weights (memory-mapped) and tokenizer, None to load them with from_pretrained")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue after the last task checkpointed in output_dir/model")
+    parser.add_argument("--verbosity", default=STEP, type=int, choices=[0, 1, 2, 3],
+                        help="Metrics logged: 0 none, 1 evaluation results, 2 also task progress, 3 also every training batch loss")
+    parser.add_argument("--metrics_output", default='-', type=str, help="File the metrics are appended to, '-' for stdout")
+    parser.add_argument("--metrics_format", default=None, type=str, choices=FORMATS,
+                        help="Format of the metrics, by default csv for a .csv file, jsonl for other files and text for stdout")
+    parser.add_argument("--metrics_flush_interval", default=5.0, type=float, help="Seconds between writes of the buffered metrics")
     
     args = parser.parse_args()
+    sink.configure(args.metrics_output, args.verbosity, args.metrics_format, args.metrics_flush_interval)
     
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case = True)
+    tokenizer = load_tokenizer('bert-base-uncased', args.weights_cache, do_lower_case = True)
     task_lists = ["cola", "sst-2", "mrpc","qqp","qnli","rte"]
 
+    saving_path = os.path.join(args.output_dir,"model")
+    if not args.resume and list_checkpoints(saving_path):
+        # a new run would replace the pretrained weights the deltas of the existing checkpoints refer to
+        raise ValueError("{} already holds checkpoints, pass --resume to continue from them".format(saving_path))
+
     my_Bert = Bert_trainer(args)
     acc_results = []
-    saving_path = os.path.join(args.output_dir,"model")
-    if  not os.path.exists(saving_path):
-        os.makedirs(saving_path)
+
+    # checkpoint i + 1 holds the weights after the i-th task, as a delta against the pretrained weights (checkpoint 0)
+    checkpoint = latest_checkpoint(saving_path) if args.resume else None
+    if checkpoint is not None:
+        acc_results = load_training_state(checkpoint, my_Bert.model, my_Bert.outer_optimizer)['acc_results']
+        log(STEP, 'resume', path = checkpoint.path, tasks_done = len(acc_results))
+    # one checkpoint per task is kept, the Adam state (for resuming) only in the last one
+    writer = CheckpointWriter(saving_path, keep=0, keep_optimizer=1)
+    if checkpoint is None:
+        save_training_state(writer, 0, my_Bert.model, my_Bert.outer_optimizer, acc_results = acc_results)
 
     for i,task in enumerate(task_lists):
+        if i < len(acc_results):
+            continue
         train_data = BertTask_Baseline(args, tokenizer,128,task,sample=args.train_sample_per_task)
-        print("Training on the {} task".format(task))
+        log(TASK, 'train_start', task = task)
         for epoch in range(args.epochs):
             outputs = my_Bert(train_data)
-        print("_____***Saving Model***___{}".format(task))
-        torch.save(my_Bert.state_dict(), os.path.join(saving_path,"{}_params.pkl".format(task)))
         
         ### Evaluating
         accs = []
         for j in range(i+1):
             eval_task = task_lists[j]
-            print("_____Evalating on the {}".format(eval_task))
             eval_data = BertTask_Baseline(args, tokenizer,128,eval_task,evaluate=True,sample=args.eval_sample_per_task)
-            acc = my_Bert(eval_data,training=False)
+            eval_start = time.time()
+            results = my_Bert(eval_data,training=False)
+            eval_time = time.time() - eval_start
+            acc = results[primary_metric(eval_task)]
             accs.append(acc)
+            record = dict(task = task, eval_task = eval_task, **results)
+            if args.bf16 and args.bf16_compare:
+                my_Bert.bf16 = False
+                eval_start = time.time()
+                acc_fp32 = my_Bert(eval_data,training=False)[primary_metric(eval_task)]
+                fp32_time = time.time() - eval_start
+                my_Bert.bf16 = True
+                record.update(bf16_delta = acc - acc_fp32, bf16_speedup = fp32_time / eval_time)
+            log(STEP, 'eval', **record)
             del eval_data
             _ = gc.collect()
-            print("_____Finishing evalating on the {}".format(eval_task))
         acc_results.append(accs)
-        print("Finishing training on the {} task".format(task))
+        save_training_state(writer, i + 1, my_Bert.model, my_Bert.outer_optimizer, acc_results = acc_results)
+        log(TASK, 'checkpoint', task = task, step = i + 1)
         del train_data
         _ = gc.collect()
 
+    writer.close()
+    sink.close()
     acc_results_pad = [line+[""]*(6-len(line)) for line in acc_results]
     final_acc = "\n".join([",".join(list(map(str,line))) for line in acc_results_pad])
     
@@ -0,0 +1,370 @@
+import os
+import re
+import json
+import pickle
+import queue
+import random
+import shutil
+import threading
+import zlib
+import numpy as np
+import torch
+
+# Resumable checkpoints written incrementally in the background.
+#
+# A checkpoint is a directory step_<n> holding index.json (dtype, shape and storage of every
+# tensor), tensors.bin (the tensor data) and state.pkl (everything that is not a tensor: RNG
+# states, sampler position, optimizer hyperparameters, ...). A keyframe stores every tensor raw,
+# 64-byte aligned, so it is loaded through a read-only memory map. The checkpoints in between
+# only store the tensors that changed since their keyframe: the XOR of the bit patterns, byte
+# shuffled (the bytes of every word grouped by significance, where small updates leave long runs
+# of zeros) and zlib compressed, or raw when that does not pay off. Tensors their keyframe does
+# not hold (e.g. the Adam moments, absent from the pretrained keyframe) are byte shuffled and zlib
+# compressed on their own. In deltas, the optimizer tensors are stored in optimizer.bin, which is
+# dropped from the older checkpoints when only the last ones are needed to resume. Tensors are only
+# read (and a delta applied to its keyframe) when they are asked for.
+
+ALIGNMENT = 64
+CHECKPOINT_DIR = re.compile(r'^step_(\d+)$')
+OPTIMIZER_PREFIX = 'optimizer.'
+
+
+def checkpoint_name(step):
+    return 'step_{:09d}'.format(step)
+
+
+def list_checkpoints(directory):
+    """
+    Complete checkpoints of directory, as (step, path) sorted by step
+    """
+    if directory is None or not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = CHECKPOINT_DIR.match(name)
+        if match and os.path.exists(os.path.join(directory, name, 'index.json')):
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def latest_checkpoint(directory):
+    """
+    LazyCheckpoint of the last complete checkpoint of directory, None if there is none
+    """
+    checkpoints = list_checkpoints(directory)
+    return LazyCheckpoint(checkpoints[-1][1]) if checkpoints else None
+
+
+def uint_view(array):
+    """
+    Flat unsigned integer view of the bits of array, for XOR
+    """
+    array = np.ascontiguousarray(array).reshape(-1)
+    return array.view(np.dtype('u{}'.format(array.dtype.itemsize)))
+
+
+def shuffle_bytes(array):
+    # byte i of every element together
+    return np.ascontiguousarray(array.reshape(-1).view(np.uint8).reshape(-1, array.dtype.itemsize).T)
+
+
+def unshuffle_bytes(data, dtype):
+    return np.ascontiguousarray(data.reshape(dtype.itemsize, -1).T).view(dtype).reshape(-1)
+
+
+class LazyCheckpoint(object):
+    """
+    Read access to a checkpoint written by CheckpointWriter; tensors are read on demand.
+    """
+    def __init__(self, path, mmap_mode='r'):
+        """
+        :param mmap_mode: 'r', or 'c' for writable copy-on-write arrays (see numpy.memmap)
+        """
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+            self.state = pickle.load(f)
+        self.step = self.index['step']
+        self.data = {}
+        self._keyframe = None
+
+    @property
+    def is_keyframe(self):
+        return self.index['keyframe'] is None
+
+    @property
+    def keyframe(self):
+        """
+        LazyCheckpoint the deltas of this checkpoint refer to (itself for a keyframe)
+        """
+        if self.is_keyframe:
+            return self
+        if self._keyframe is None:
+            self._keyframe = LazyCheckpoint(os.path.join(os.path.dirname(self.path), self.index['keyframe']),
+                                            self.mmap_mode)
+        return self._keyframe
+
+    def keys(self):
+        return self.index['tensors'].keys()
+
+    def __contains__(self, name):
+        return name in self.index['tensors']
+
+    def array(self, name):
+        """
+        numpy array of tensor name, a view of the memory map for raw tensors
+        """
+        entry = self.index['tensors'][name]
+        dtype, shape = np.dtype(entry['dtype']), tuple(entry['shape'])
+        if entry['kind'] == 'same':
+            return self.keyframe.array(name)
+        data_file = entry.get('file', 'tensors.bin')
+        if data_file not in self.data:
+            self.data[data_file] = np.memmap(os.path.join(self.path, data_file), dtype=np.uint8, mode=self.mmap_mode)
+        stored = self.data[data_file][entry['offset']:entry['offset'] + entry['nbytes']]
+        if entry['kind'] == 'raw':
+            return stored.view(dtype).reshape(shape)
+        unpacked = unshuffle_bytes(np.frombuffer(zlib.decompress(stored), dtype=np.uint8), dtype)
+        if entry['kind'] == 'zlib':
+            return unpacked.reshape(shape)
+        delta = unpacked
+        return (uint_view(self.keyframe.array(name)) ^ uint_view(delta)).view(dtype).reshape(shape)
+
+    def tensor(self, name):
+        """
+        Tensor name, as a new tensor (the memory maps are read-only)
+        """
+        return torch.from_numpy(np.array(self.array(name)))
+
+    def load_module(self, module, prefix='model.'):
+        """
+        Copy the state_dict entries of module from the checkpoint, one tensor at a time
+        """
+        with torch.no_grad():
+            for name, value in module.state_dict(keep_vars=True).items():
+                value.copy_(self.tensor(prefix + name))
+
+    def load_optimizer(self, optimizer, prefix=OPTIMIZER_PREFIX):
+        state = self.state[prefix]
+        if self.index.get('optimizer_dropped'):
+            raise ValueError("{} no longer holds the optimizer state, resume from the last checkpoint".format(self.path))
+        optimizer.load_state_dict({
+            'state': {index: {key: self.tensor(value) if isinstance(value, str) and value.startswith(prefix) else value
+                              for key, value in param_state.items()}
+                      for index, param_state in state['state'].items()},
+            'param_groups': state['param_groups']})
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints to directory on a background thread.
+
+    The first checkpoint (typically the pretrained weights, see save_training_state) is a keyframe,
+    the following ones are deltas against the last keyframe, a new keyframe is written every
+    keyframe_every checkpoints (0 to keep the first one). Only the keep last checkpoints are
+    kept, together with the keyframes they refer to.
+    """
+    def __init__(self, directory, keyframe_every=0, keep=2, compress_level=1, keep_optimizer=0):
+        """
+        :param compress_level: zlib level of the deltas
+        :param keep_optimizer: number of last checkpoints keeping the optimizer state, which only resuming
+                               needs, it is dropped from the older deltas; 0 to keep it in every checkpoint
+        """
+        self.directory = directory
+        self.keyframe_every = keyframe_every
+        self.keep = keep
+        self.keep_optimizer = keep_optimizer
+        self.compress_level = compress_level
+        os.makedirs(directory, exist_ok=True)
+
+        # continue the keyframe sequence of an existing directory
+        latest = latest_checkpoint(directory)
+        self.keyframe = latest.keyframe if latest is not None else None
+        self.since_keyframe = 0 if latest is None or latest.is_keyframe else 1
+
+        # one checkpoint written while the next one is queued: save() waits beyond that
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, step, tensors, state):
+        """
+        Snapshot tensors (dict name -> tensor) and state (picklable dict) as checkpoint step and return;
+        the copy to host memory is the only work done on the calling thread.
+        """
+        if self.error is not None:
+            raise self.error
+        arrays = {name: tensor.detach().to('cpu', copy=True).numpy() for name, tensor in tensors.items()}
+        self.queue.put((step, arrays, pickle.dumps(state)))
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, step, arrays, state):
+        name = checkpoint_name(step)
+        # never a delta against the checkpoint it replaces
+        is_keyframe = (self.keyframe is None or os.path.basename(self.keyframe.path) == name
+                       or (self.keyframe_every > 0 and self.since_keyframe >= self.keyframe_every))
+        path = os.path.join(self.directory, name)
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        entries, files, offsets = {}, {}, {}
+        try:
+            for tensor_name, array in arrays.items():
+                entry = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+                data = array
+                kind = 'raw'
+                if not is_keyframe:
+                    base = self.keyframe.array(tensor_name) if tensor_name in self.keyframe else None
+                    if base is not None and base.dtype == array.dtype and base.shape == array.shape:
+                        delta = uint_view(array) ^ uint_view(base)
+                        if not delta.any():
+                            kind, data = 'same', None
+                        else:
+                            kind, data = 'xor', shuffle_bytes(delta)
+                    else:
+                        kind, data = 'zlib', shuffle_bytes(uint_view(array))
+                    if data is not None:
+                        compressed = zlib.compress(data, self.compress_level)
+                        if len(compressed) < array.nbytes * 0.9:
+                            data = np.frombuffer(compressed, dtype=np.uint8)
+                        else:
+                            kind, data = 'raw', array
+                entry['kind'] = kind
+                if data is not None:
+                    # the optimizer state of a delta in its own file, which prune may drop
+                    data_file = 'optimizer.bin' if not is_keyframe and tensor_name.startswith(OPTIMIZER_PREFIX) else 'tensors.bin'
+                    if data_file not in files:
+                        files[data_file] = open(os.path.join(tmp_path, data_file), 'wb')
+                        offsets[data_file] = 0
+                    f, offset = files[data_file], offsets[data_file]
+                    padding = -offset % ALIGNMENT
+                    f.write(b'\0' * padding)
+                    offset += padding
+                    data = np.ascontiguousarray(data)
+                    f.write(data.tobytes())
+                    entry['offset'], entry['nbytes'] = offset, data.nbytes
+                    if data_file != 'tensors.bin':
+                        entry['file'] = data_file
+                    offsets[data_file] = offset + data.nbytes
+                entries[tensor_name] = entry
+        finally:
+            for f in files.values():
+                f.close()
+
+        with open(os.path.join(tmp_path, 'state.pkl'), 'wb') as f:
+            f.write(state)
+        index = {'step': step, 'keyframe': None if is_keyframe else os.path.basename(self.keyframe.path),
+                 'tensors': entries}
+        # index.json last: a checkpoint without it is incomplete and ignored
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+        if is_keyframe:
+            self.keyframe = LazyCheckpoint(path)
+            self.since_keyframe = 0
+        self.since_keyframe += 1
+        self.prune()
+
+    def prune(self):
+        checkpoints = list_checkpoints(self.directory)
+        kept = checkpoints[-self.keep:] if self.keep > 0 else checkpoints
+        needed = {path for _, path in kept}
+        needed.update(LazyCheckpoint(path).keyframe.path for _, path in kept)
+        needed.add(self.keyframe.path)
+        for _, path in checkpoints:
+            if path not in needed:
+                shutil.rmtree(path, ignore_errors=True)
+        if self.keep_optimizer > 0:
+            for _, path in kept[:-self.keep_optimizer]:
+                self.drop_optimizer(path)
+
+    def drop_optimizer(self, path):
+        """
+        Remove the optimizer state of a delta checkpoint (a keyframe keeps it, deltas may refer to it)
+        """
+        if not os.path.exists(os.path.join(path, 'optimizer.bin')):
+            return
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        index['tensors'] = {name: entry for name, entry in index['tensors'].items() if entry.get('file') != 'optimizer.bin'}
+        index['optimizer_dropped'] = True
+        tmp_index = os.path.join(path, 'index.json.tmp{}'.format(os.getpid()))
+        with open(tmp_index, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_index, os.path.join(path, 'index.json'))
+        os.remove(os.path.join(path, 'optimizer.bin'))
+
+
+def rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_training_state(writer, step, model, optimizer, **state):
+    """
+    Checkpoint the weights of model, the state of its optimizer, the RNG states and state
+    (sampler position, ...) as checkpoint step of writer.
+    """
+    tensors = {'model.' + name: value for name, value in model.state_dict().items()}
+    optimizer_state = optimizer.state_dict()
+    # optimizer tensors (Adam moments, ...) go through the delta store, replaced by their names in the
+    # state (state_dict shares the per-parameter dicts with the optimizer, they are rebuilt)
+    packed = {}
+    for index, param_state in optimizer_state['state'].items():
+        packed[index] = {}
+        for key, value in param_state.items():
+            if torch.is_tensor(value):
+                name = 'optimizer.{}.{}'.format(index, key)
+                tensors[name] = value
+                value = name
+            packed[index][key] = value
+    optimizer_state = {'state': packed, 'param_groups': optimizer_state['param_groups']}
+    state = dict(state, **{'optimizer.': optimizer_state, 'rng': rng_state()})
+    writer.save(step, tensors, state)
+
+
+def load_training_state(checkpoint, model, optimizer):
+    """
+    Restore what save_training_state saved into model, optimizer and the RNGs.
+    :return: the other state entries
+    """
+    checkpoint.load_module(model)
+    checkpoint.load_optimizer(optimizer)
+    set_rng_state(checkpoint.state['rng'])
+    return {key: value for key, value in checkpoint.state.items() if key not in ('optimizer.', 'rng')}
@@ -0,0 +1,77 @@
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+# Data-parallel meta-training: every rank adapts a disjoint share of each outer batch of tasks and
+# the meta-gradients are summed over ranks before the outer step, which gives the same update as
+# one process adapting the whole batch.
+#
+# USAGE: python -m torch.distributed.launch --nproc_per_node 4 main.py ...   (or torchrun)
+
+
+def init_distributed(args):
+    """
+    Join the process group when launched by torch.distributed.launch / torchrun, no-op otherwise.
+    """
+    args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+    if args.local_rank == -1:
+        return
+    dist.init_process_group(backend=args.dist_backend, init_method='env://')
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_parameters(model, src=0):
+    """
+    Copy the weights of rank src (e.g. its randomly initialised classifier) to every rank.
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src)
+
+
+def all_reduce_sum(tensors):
+    """
+    Sum a list of tensors over all ranks with a single all-reduce.
+    :return: list of reduced tensors, detached from autograd
+    """
+    if not is_distributed():
+        return tensors
+    flat = _flatten_dense_tensors([t.detach() for t in tensors])
+    dist.all_reduce(flat)
+    return list(_unflatten_dense_tensors(flat, tensors))
+
+
+def all_reduce_(tensor):
+    """
+    Sum a (flat) tensor over all ranks in place.
+    """
+    if is_distributed():
+        dist.all_reduce(tensor)
+    return tensor
+
+
+def mean_over_ranks(values):
+    """
+    Mean of the 0-d tensors values of every rank (a rank may have none).
+    :return: (mean as a 0-d tensor, number of values over all ranks); without distributed training the
+             mean stays on the device of values, nothing is read back
+    """
+    if not is_distributed():
+        return torch.stack(values).mean(), float(len(values))
+    total = torch.stack(values).sum().cpu() if values else torch.zeros((), dtype=torch.float64)
+    total, count = all_reduce_sum([torch.stack([total.double(), torch.tensor(float(len(values)), dtype=torch.float64)])])[0].tolist()
+    return torch.tensor(total / count, dtype=torch.float64), count
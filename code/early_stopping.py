@@ -0,0 +1,43 @@
+import torch
+
+
+class InnerLoopStopper(object):
+    """
+    Convergence test of the inner loop, called after every epoch over the support set.
+
+    Adaptation to a task stops once the mean support loss of an epoch improved by less than
+    loss_tolerance over the previous epoch, or the mean gradient norm of the epoch fell below
+    grad_norm_threshold. A criterion set to 0 is disabled; inner_update_step stays the hard cap.
+    """
+    def __init__(self, loss_tolerance=0.0, grad_norm_threshold=0.0):
+        self.loss_tolerance      = loss_tolerance
+        self.grad_norm_threshold = grad_norm_threshold
+        self.previous_loss = None
+
+    @property
+    def enabled(self):
+        return self.loss_tolerance > 0 or self.grad_norm_threshold > 0
+
+    def reset(self):
+        self.previous_loss = None
+
+    def converged(self, epoch_losses, epoch_grad_norms=None):
+        """
+        :param epoch_losses: support losses (0-d tensors) of the inner steps of the epoch, read back once
+        :param epoch_grad_norms: gradient norms (tensors) of the inner steps of the epoch
+        """
+        loss = torch.stack(epoch_losses).mean().item()
+        improved = self.previous_loss is None or self.previous_loss - loss >= self.loss_tolerance
+        self.previous_loss = loss
+        if self.loss_tolerance > 0 and not improved:
+            return True
+        if self.grad_norm_threshold > 0 and epoch_grad_norms:
+            return torch.stack(epoch_grad_norms).mean().item() < self.grad_norm_threshold
+        return False
+
+
+def grad_norm(params):
+    """
+    L2 norm of the gradients of params, as a tensor (no device sync)
+    """
+    return torch.norm(torch.stack([p.grad.detach().norm() for p in params if p.grad is not None]))
@@ -0,0 +1,116 @@
+import os
+import re
+import json
+import pickle
+import contextlib
+import torch
+from checkpoint import CheckpointWriter, LazyCheckpoint, list_checkpoints
+
+# Fast process startup from a local cache of the pretrained model and tokenizer.
+#
+# The weights of a pretrained BERT are converted once into a keyframe of checkpoint.py (raw,
+# aligned tensors) and afterwards mapped copy-on-write into the model parameters: nothing is
+# deserialized or randomly initialized, pages are read when first touched and shared through the
+# page cache by every process of the box until a process writes to them. The tokenizer is cached
+# pickled, which skips the vocab parsing and, for a model name, the remote lookup of
+# from_pretrained. transformers itself is only imported when a model or tokenizer is built.
+
+
+def cache_key(bert_model):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', bert_model.strip('/'))
+
+
+@contextlib.contextmanager
+def skip_init(model_class):
+    """
+    Construct modules without initializing their weights (they are all overwritten right after)
+    """
+    # on the class defining _init_weights, which the encoder submodule uses too
+    owner = next(cls for cls in model_class.__mro__ if '_init_weights' in cls.__dict__)
+    patched = [(owner, '_init_weights', lambda self, module: None)]
+    patched += [(cls, 'reset_parameters', lambda self: None) for cls in (torch.nn.Linear, torch.nn.Embedding, torch.nn.LayerNorm)]
+    originals = [(owner, name, owner.__dict__.get(name)) for owner, name, _ in patched]
+    for owner, name, replacement in patched:
+        setattr(owner, name, replacement)
+    try:
+        yield
+    finally:
+        for owner, name, original in originals:
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+
+def build_weights_cache(path, bert_model):
+    """
+    Convert the pretrained encoder of bert_model into the weights cache at path
+    """
+    from transformers import BertModel
+    model = BertModel.from_pretrained(bert_model)
+    os.makedirs(path, exist_ok=True)
+    # without the private entries newer transformers serialize (they would pin the attention implementation)
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump({key: value for key, value in model.config.to_dict().items() if not key.startswith('_')}, f, indent=2)
+    writer = CheckpointWriter(path, keep=0)
+    writer.save(0, {'bert.' + name: value for name, value in model.state_dict().items()}, {'bert_model': bert_model})
+    writer.close()
+
+
+def load_pretrained(bert_model, num_labels, cache_dir=None):
+    """
+    BertForSequenceClassification with the pretrained weights of bert_model, as from_pretrained.
+
+    :param cache_dir: directory of the weights cache, built on first use; None for from_pretrained.
+                      The cache is not invalidated when the weights of bert_model change.
+    """
+    from transformers import BertConfig, BertForSequenceClassification
+    if cache_dir is None:
+        return BertForSequenceClassification.from_pretrained(bert_model, num_labels = num_labels)
+
+    path = os.path.join(cache_dir, cache_key(bert_model))
+    if not list_checkpoints(path):
+        build_weights_cache(path, bert_model)
+    weights = LazyCheckpoint(list_checkpoints(path)[0][1], mmap_mode='c')
+
+    config = BertConfig.from_pretrained(path, num_labels = num_labels)
+    with skip_init(BertForSequenceClassification):
+        model = BertForSequenceClassification(config)
+
+    with torch.no_grad():
+        for name, value in model.state_dict(keep_vars=True).items():
+            if name in weights:
+                value.data = torch.from_numpy(weights.array(name))
+    # the classification head is not part of the pretrained weights
+    model._init_weights(model.classifier)
+    return model
+
+
+def load_tokenizer(bert_model, cache_dir=None, do_lower_case=True):
+    """
+    Tokenizer of bert_model, pickled in cache_dir on first use (None for from_pretrained).
+
+    BertTokenizerFast when this transformers has it (its batch_encode_plus tokenizes the whole
+    batch in native code), BertTokenizer otherwise; both produce the same token ids.
+    """
+    try:
+        from transformers import BertTokenizerFast as tokenizer_class
+    except ImportError:
+        from transformers import BertTokenizer as tokenizer_class
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, '{}.{}.{}.pkl'.format(cache_key(bert_model), int(do_lower_case),
+                                                            tokenizer_class.__name__))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+    tokenizer = tokenizer_class.from_pretrained(bert_model, do_lower_case = do_lower_case)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(tokenizer, f)
+        os.replace(tmp_path, path)
+    return tokenizer
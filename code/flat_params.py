@@ -0,0 +1,24 @@
+import torch
+
+# Flat parameter-sized buffers: one contiguous allocation holding a tensor per parameter,
+# accessed through views shaped like the parameters.
+
+
+def flat_buffer(params, device=None, dtype=None):
+    """
+    Zero-filled 1-D tensor with room for all params
+    """
+    params = list(params)
+    return torch.zeros(sum(p.numel() for p in params), device=device or params[0].device,
+                       dtype=dtype or params[0].dtype)
+
+
+def flat_views(buffer, params):
+    """
+    Views of consecutive slices of buffer, shaped like params
+    """
+    views, offset = [], 0
+    for p in params:
+        views.append(buffer[offset:offset + p.numel()].view_as(p))
+        offset += p.numel()
+    return views
@@ -3,12 +3,12 @@ import torch.nn.functional as F
 import torch.nn as nn
 import math
 import torch
+from torch.utils.checkpoint import checkpoint as checkpoint_layer
 from collections import OrderedDict
-from transformers import BertModel, BertTokenizer, BertForSequenceClassification
 
 def functional_bert(fast_weights, config, input_ids=None, attention_mask=None, token_type_ids=None,
                     position_ids=None, head_mask=None, inputs_embeds=None, encoder_hidden_states=None,
-                    encoder_attention_mask=None, is_train = True):
+                    encoder_attention_mask=None, is_train = True, checkpoint = False):
 
     if input_ids is not None and inputs_embeds is not None:
         raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
@@ -77,13 +77,49 @@ def functional_bert(fast_weights, config, input_ids=None, attention_mask=None, t
     encoder_outputs = functional_encoder(fast_weights, config, embedding_output,
                                    attention_mask=extended_attention_mask,
                                    head_mask=head_mask, encoder_hidden_states=encoder_hidden_states,
-                                   encoder_attention_mask=encoder_extended_attention_mask, is_train = is_train)
+                                   encoder_attention_mask=encoder_extended_attention_mask, is_train = is_train,
+                                   checkpoint = checkpoint)
     
     sequence_output = encoder_outputs
-    outputs = (sequence_output,)
+    pooled_output = functional_pooler(fast_weights, config, sequence_output)
+    outputs = (sequence_output, pooled_output)
     return outputs
 
 
+def functional_pooler(fast_weights, config, hidden_states):
+    # "pool" the model by taking the hidden state of the first token
+    first_token_tensor = hidden_states[:, 0]
+    pooled_output = F.linear(first_token_tensor, fast_weights['bert.pooler.dense.weight'],
+                             fast_weights['bert.pooler.dense.bias'])
+    return torch.tanh(pooled_output)
+
+
+def functional_classifier(fast_weights, config, pooled_output, labels=None, is_train = True):
+    
+    pooled_output = F.dropout(pooled_output, p=config.hidden_dropout_prob, training = is_train)
+    logits = F.linear(pooled_output, fast_weights['classifier.weight'], fast_weights['classifier.bias'])
+    
+    outputs = (logits,)
+    if labels is not None:
+        if config.num_labels == 1:
+            loss = F.mse_loss(logits.view(-1), labels.view(-1))
+        else:
+            loss = F.cross_entropy(logits.view(-1, config.num_labels), labels.view(-1))
+        outputs = (loss,) + outputs
+    return outputs
+
+
+def functional_bert_for_sequence_classification(fast_weights, config, input_ids=None, attention_mask=None,
+                                                token_type_ids=None, labels=None, is_train = True, checkpoint = False):
+    """
+    BertForSequenceClassification forward from fast_weights (named like its parameters),
+    returns (loss, logits) when labels are given, (logits,) otherwise
+    """
+    pooled_output = functional_bert(fast_weights, config, input_ids=input_ids, attention_mask=attention_mask,
+                                    token_type_ids=token_type_ids, is_train = is_train, checkpoint = checkpoint)[1]
+    return functional_classifier(fast_weights, config, pooled_output, labels, is_train)
+
+
 def functional_embeeding(fast_weights, config, input_ids, position_ids, 
                          token_type_ids, inputs_embeds = None, is_train = True):
 
@@ -248,18 +284,28 @@ def functional_layer(fast_weights, config, layer_idx, hidden_states, attention_m
     
 
 def functional_encoder(fast_weights, config , hidden_states, attention_mask,
-                       head_mask, encoder_hidden_states, encoder_attention_mask, is_train = True):
-    
+                       head_mask, encoder_hidden_states, encoder_attention_mask, is_train = True, checkpoint = False):
+    """
+    :param checkpoint: keep only the input of every layer for backward and recompute the layer
+                       (with the same dropout masks) when its gradient is needed
+    """
     for i in range(0,config.num_hidden_layers):
-        layer_outputs = functional_layer(fast_weights, config, str(i),
-                                         hidden_states, attention_mask, head_mask[i], 
-                                         encoder_hidden_states, encoder_attention_mask, is_train)
+        if checkpoint:
+            layer_outputs = checkpoint_layer(functional_layer, fast_weights, config, str(i),
+                                             hidden_states, attention_mask, head_mask[i],
+                                             encoder_hidden_states, encoder_attention_mask, is_train,
+                                             use_reentrant = False)
+        else:
+            layer_outputs = functional_layer(fast_weights, config, str(i),
+                                             hidden_states, attention_mask, head_mask[i], 
+                                             encoder_hidden_states, encoder_attention_mask, is_train)
         hidden_states = layer_outputs
         
     outputs = hidden_states
     return outputs
 
 if __name__ == '__main__':
+    from transformers import BertForSequenceClassification
     
     model = BertForSequenceClassification.from_pretrained('bert-base-uncased')
     fast_weights = OrderedDict(model.named_parameters())
@@ -273,4 +319,10 @@ if __name__ == '__main__':
     
     print(functional_bert(fast_weights, model.config, input_ids=input_ids, attention_mask=attention_mask, 
                     token_type_ids=token_type_ids,is_train = True))
+    
+    model.eval()
+    print(functional_bert_for_sequence_classification(fast_weights, model.config, input_ids=input_ids,
+                                                      attention_mask=attention_mask, token_type_ids=token_type_ids,
+                                                      is_train = False)[0])
+    print(model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0])
     
\ No newline at end of file
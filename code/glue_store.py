@@ -0,0 +1,168 @@
+import os
+import json
+import random
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+from transformers import glue_processors as processors
+from transformers import glue_output_modes as output_modes
+from transformers import glue_convert_examples_to_features as convert_examples_to_features
+
+# Pre-tokenized GLUE feature store.
+#
+# build_feature_store parses a GLUE TSV once and writes, per task and split, into <output_dir>/<task>-<split>-<max_seq_length>/:
+#   input_ids.bin       token ids of all examples, unpadded and concatenated (uint16 when the vocab fits, else int32)
+#   token_type_ids.bin  segment ids, same layout (uint8)
+#   offsets.npy         int64 [num_examples + 1], example i is input_ids[offsets[i]:offsets[i+1]]
+#   labels.npy          int64 labels (classification) or float32 scores (regression)
+#   meta.json           num_examples, max_seq_length, output_mode, dtypes
+#
+# FeatureStore memory-maps these files, so sampling a task slices k rows by index without parsing text
+# or holding the corpus in RAM, and concurrent processes share the pages.
+#
+# USAGE: python glue_store.py --data_dir glue_data --bert_model bert-base-uncased --output_dir glue_store
+
+
+TASK_FOLDERS = {'cola': 'CoLA', 'mnli-mm': 'MNLI'}
+
+
+def task_data_dir(data_dir, task):
+    return os.path.join(data_dir, TASK_FOLDERS.get(task, task.upper()))
+
+
+def store_path(store_dir, task, max_seq_length, evaluate=False):
+    return os.path.join(store_dir, '{}-{}-{}'.format(task, 'dev' if evaluate else 'train', max_seq_length))
+
+
+def build_feature_store(task, data_dir, tokenizer, max_seq_length, output_dir, evaluate=False, chunk_size=10000):
+    """
+    Tokenize every example of a GLUE task split once and write it to the memory-mappable layout above.
+    :param task: GLUE task name, key of glue_processors
+    :param data_dir: folder containing the GLUE task folders
+    :param tokenizer: tokenizer uses to tokenzie from word to sequence
+    :param max_seq_length: length of the tokenzier vector
+    :param output_dir: root folder of the feature store
+    :param evaluate: build the dev split instead of the train split
+    :param chunk_size: number of examples converted to features at a time
+    :return: path of the task store
+    """
+    processor   = processors[task]()
+    output_mode = output_modes[task]
+    label_list  = processor.get_labels()
+    task_dir    = task_data_dir(data_dir, task)
+    examples    = processor.get_dev_examples(task_dir) if evaluate else processor.get_train_examples(task_dir)
+
+    path = store_path(output_dir, task, max_seq_length, evaluate)
+    os.makedirs(path, exist_ok=True)
+    id_dtype = np.uint16 if len(tokenizer.vocab) <= np.iinfo(np.uint16).max + 1 else np.int32
+
+    lengths, labels = [], []
+    with open(os.path.join(path, 'input_ids.bin'), 'wb') as ids_file, \
+         open(os.path.join(path, 'token_type_ids.bin'), 'wb') as types_file:
+        for start in range(0, len(examples), chunk_size):
+            features = convert_examples_to_features(
+                examples[start:start + chunk_size], tokenizer, max_length=max_seq_length,
+                label_list=label_list, output_mode=output_mode,
+            )
+            for f in features:
+                length = int(sum(f.attention_mask))
+                ids_file.write(np.asarray(f.input_ids[:length], dtype=id_dtype).tobytes())
+                types_file.write(np.asarray(f.token_type_ids[:length], dtype=np.uint8).tobytes())
+                lengths.append(length)
+                labels.append(f.label)
+
+    np.save(os.path.join(path, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    np.save(os.path.join(path, 'labels.npy'),
+            np.asarray(labels, dtype=np.int64 if output_mode == 'classification' else np.float32))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'task': task, 'num_examples': len(lengths), 'max_seq_length': max_seq_length,
+                   'output_mode': output_mode, 'id_dtype': np.dtype(id_dtype).name}, f)
+    return path
+
+
+class FeatureStore(object):
+    """
+    Read-only, memory-mapped view of a task store written by build_feature_store.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.max_seq_length = self.meta['max_seq_length']
+        self.input_ids      = np.memmap(os.path.join(path, 'input_ids.bin'), dtype=self.meta['id_dtype'], mode='r')
+        self.token_type_ids = np.memmap(os.path.join(path, 'token_type_ids.bin'), dtype=np.uint8, mode='r')
+        self.offsets        = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.labels         = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.meta['num_examples']
+
+    def sample(self, k):
+        """
+        TensorDataset of k random examples, drawn without replacement unless the task has fewer than k.
+        """
+        if len(self) < k:
+            indices = random.choices(range(len(self)), k=k)
+        else:
+            indices = random.sample(range(len(self)), k)
+        return self.dataset(indices)
+
+    def dataset(self, indices):
+        """
+        TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_labels) of the given examples,
+        padded to max_seq_length like convert_examples_to_features.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts  = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        span    = np.concatenate([np.arange(s, s + n) for s, n in zip(starts, lengths)])
+
+        rows = torch.from_numpy(np.repeat(np.arange(len(indices)), lengths))
+        cols = torch.from_numpy(np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        all_input_ids      = torch.zeros(len(indices), self.max_seq_length, dtype=torch.long)
+        all_token_type_ids = torch.zeros(len(indices), self.max_seq_length, dtype=torch.long)
+        all_input_ids[rows, cols]      = torch.from_numpy(self.input_ids[span].astype(np.int64))
+        all_token_type_ids[rows, cols] = torch.from_numpy(self.token_type_ids[span].astype(np.int64))
+        all_attention_mask = (torch.arange(self.max_seq_length)[None, :] < torch.from_numpy(lengths)[:, None]).long()
+        all_labels = torch.from_numpy(np.array(self.labels[indices]))
+
+        return TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_labels)
+
+
+_open_stores = {}
+
+def open_feature_store(store_dir, task, max_seq_length, evaluate=False):
+    """
+    FeatureStore of a task split, None if it was not built. Stores are opened once per process.
+    """
+    path = store_path(store_dir, task, max_seq_length, evaluate)
+    if path not in _open_stores:
+        _open_stores[path] = FeatureStore(path) if os.path.exists(os.path.join(path, 'meta.json')) else None
+    return _open_stores[path]
+
+
+def main():
+    from transformers import BertTokenizer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default=None, type=str, required=True,
+                        help="The input data dir. Should contain the GLUE task folders.")
+    parser.add_argument("--bert_model", default='bert-base-uncased', type=str,
+                        help="The type of bert model")
+    parser.add_argument("--output_dir", default='glue_store', type=str,
+                        help="Root folder of the feature store")
+    parser.add_argument("--max_seq_length", default=128, type=int,
+                        help="Length of the tokenzier vector")
+    parser.add_argument("--tasks", default=','.join(processors.keys()), type=str,
+                        help="Comma separated GLUE tasks to build")
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case = True)
+    for task in args.tasks.split(','):
+        for evaluate in (False, True):
+            path = build_feature_store(task, args.data_dir, tokenizer, args.max_seq_length, args.output_dir, evaluate)
+            print("Built {}".format(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+import csv
+import random
+from transformers import glue_processors as processors
+from glue_store import task_data_dir
+
+# Streaming GLUE example sampler: reads a task TSV line by line and keeps a reservoir of k rows,
+# so drawing k examples needs O(k) memory whatever the size of the corpus.
+
+DEV_FILES = {'mnli': 'dev_matched.tsv', 'mnli-mm': 'dev_mismatched.tsv'}
+HEADERLESS_TASKS = {'cola'}
+
+
+def reservoir_sample(iterable, k, rng=random):
+    """
+    Uniformly sample k items of an iterable of unknown length in a single pass (Algorithm R).
+    :return: list of min(k, len(iterable)) items, in random order
+    """
+    reservoir = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(i + 1)
+            if j < k:
+                reservoir[j] = item
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+def stream_sample_examples(task, data_dir, k, evaluate=False, rng=random):
+    """
+    InputExamples of k random rows of a GLUE task split, read in one streaming pass over its TSV.
+    Rows are drawn with replacement when the split has fewer than k rows.
+    :param task: GLUE task name, key of glue_processors
+    :param data_dir: folder containing the GLUE task folders
+    :param k: number of examples (k_support + k_query)
+    :param evaluate: sample the dev split instead of the train split
+    """
+    processor = processors[task]()
+    file_name = DEV_FILES.get(task, 'dev.tsv') if evaluate else 'train.tsv'
+    set_type  = 'dev' if evaluate else 'train'
+
+    with open(os.path.join(task_data_dir(data_dir, task), file_name), encoding='utf-8-sig') as f:
+        reader = csv.reader(f, delimiter='\t', quotechar=None)
+        header = [] if task in HEADERLESS_TASKS else [next(reader)]
+        lines  = reservoir_sample(reader, k, rng)
+
+    if len(lines) < k:
+        lines = rng.choices(lines, k=k)
+
+    # the processors skip the first line as header, except for headerless tasks
+    return processor._create_examples(header + lines, set_type)
@@ -2,7 +2,6 @@ import json
 from random import shuffle
 from collections import Counter
 import torch
-from transformers import BertModel, BertTokenizer
 import time
 import logging
 import argparse
@@ -10,9 +9,17 @@ import os
 logger = logging.getLogger()
 logger.setLevel(logging.CRITICAL)
 os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
-from reptile import Learner
-from task import MetaTask
+from task import MetaTask, DomainIndex, TaskStream
+from token_cache import TokenCache
+from prefetch import prefetch_batch_of_tasks, prefetch_task_stream
+from distributed import init_distributed, get_rank, get_world_size
+from async_eval import AsyncEvaluator
+from fast_startup import load_tokenizer
+from checkpoint import CheckpointWriter, list_checkpoints, latest_checkpoint, save_training_state, load_training_state
+from profiling import profiler, phase
+from metrics_sink import sink, log, QUIET, STEP, FORMATS
 import random
+import importlib
 import numpy as np
 
 def random_seed(value):
@@ -22,14 +29,105 @@ def random_seed(value):
     np.random.seed(value)
     random.seed(value)
 
-def create_batch_of_tasks(taskset, is_shuffle = True, batch_size = 4):
-    idxs = list(range(0,len(taskset)))
+def batch_task_indices(num_task, is_shuffle = True, batch_size = 4, seed = None, rank = 0, world_size = 1):
+    """
+    Task indices of every outer batch. In distributed mode every rank gets its share
+    (every world_size-th task) of the same, identically shuffled, batches.
+    """
+    idxs = list(range(0,num_task))
     if is_shuffle:
-        random.shuffle(idxs)
-    for i in range(0,len(idxs), batch_size):
-        yield [taskset[idxs[i]] for i in range(i, min(i + batch_size,len(taskset)))]
+        random.Random(seed).shuffle(idxs)
+    return [idxs[i:i + batch_size][rank::world_size] for i in range(0,len(idxs), batch_size)]
 
-def main():
+def create_batch_of_tasks(taskset, is_shuffle = True, batch_size = 4, seed = None, rank = 0, world_size = 1):
+    for batch in batch_task_indices(len(taskset), is_shuffle, batch_size, seed, rank, world_size):
+        yield [taskset[i] for i in batch]
+
+def test_accuracy(learner, test, rank = 0, world_size = 1):
+    """
+    Mean query accuracy of the learner adapted to every test task, with the fixed test seed,
+    and the inner epochs it used on the test tasks of this rank
+    """
+    random_seed(123)
+    db_test = create_batch_of_tasks(test, is_shuffle = False, batch_size = world_size,
+                                    rank = rank, world_size = world_size)
+    acc_sum_test = []
+    inner_steps = 0
+
+    for start, test_batch in zip(range(0, len(test), world_size), db_test):
+        acc = learner(test_batch, training = False)
+        # acc is the mean over the tasks of the batch on every rank, the last batch may be smaller
+        acc_sum_test.append(acc * min(world_size, len(test) - start))
+        inner_steps += sum(getattr(learner, 'inner_steps_used', []))
+
+    # the accuracies of all test batches are read back together
+    return (torch.stack(acc_sum_test).sum() / len(test)).item(), inner_steps
+
+def epoch_task_batches(args, examples, domain_index, tokenizer, token_cache, rank = 0, world_size = 1, start_step = 0):
+    """
+    (step, task batch) of every epoch, building a new MetaTask of num_task_train tasks per epoch.
+    start_step skips the outer batches of a resumed run, without building their tasks.
+    """
+    steps_per_epoch = (args.num_task_train + args.outer_batch_size - 1) // args.outer_batch_size
+    for epoch in range(start_step // steps_per_epoch, args.epoch):
+
+        train = MetaTask(examples, num_task = args.num_task_train, k_support=args.k_spt, 
+                         k_query=args.k_qry, tokenizer = tokenizer,
+                         domain_index = domain_index, seed = args.seed + epoch,
+                         token_cache = token_cache)
+
+        skip = max(start_step - epoch * steps_per_epoch, 0)
+        batch_indices = batch_task_indices(len(train), is_shuffle = True, batch_size = args.outer_batch_size,
+                                           seed = args.seed + epoch, rank = rank, world_size = world_size)[skip:]
+        if args.num_workers > 0:
+            # the workers only get the cached ids of this epoch's texts
+            train.token_cache = token_cache.subset(example['text'] for task in train.supports + train.queries
+                                                   for example in task)
+            db = prefetch_batch_of_tasks(train, batch_indices, num_workers = args.num_workers,
+                                         queue_depth = args.prefetch_depth, seed = args.seed + epoch,
+                                         token_cache = token_cache)
+        else:
+            db = ([train[i] for i in batch] for batch in batch_indices)
+
+        for step, task_batch in enumerate(db, skip):
+            yield step, task_batch
+
+        if rank == 0:
+            token_cache.save()
+
+def stream_task_batches(args, stream, token_cache, rank = 0):
+    """
+    (step, task batch) drawn lazily from a TaskStream, for as many outer steps as the epochs would take.
+    stream.position counts the batches handed out, so it can be saved to resume the same task sequence.
+    """
+    steps_per_epoch = (args.num_task_train + args.outer_batch_size - 1) // args.outer_batch_size
+    if args.num_workers > 0:
+        db = prefetch_task_stream(stream, num_workers = args.num_workers, queue_depth = args.prefetch_depth,
+                                  seed = args.seed + stream.position, token_cache = token_cache)
+    else:
+        db = stream
+
+    for position, task_batch in zip(range(stream.position, args.epoch * steps_per_epoch), db):
+        stream.position = position + 1
+        yield position % steps_per_epoch, task_batch
+
+        if rank == 0 and stream.position % steps_per_epoch == 0:
+            token_cache.save()
+
+def report_async_results(results, target_acc = None, world_size = 1):
+    """
+    Log the (global step, test accuracy, elapsed) results of an AsyncEvaluator.
+    :return: True when one reached target_acc (only checked without distributed training, as the
+             other ranks do not see the results)
+    """
+    for global_step, acc_test, elapsed in results:
+        log(STEP, 'test', global_step = global_step, test_acc = acc_test, elapsed = elapsed)
+        if target_acc is not None and world_size == 1 and acc_test >= target_acc:
+            log(STEP, 'target_reached', target_acc = target_acc, outer_steps = global_step + 1, elapsed = elapsed)
+            return True
+    return False
+
+def get_parser():
     
     parser = argparse.ArgumentParser()
     
@@ -74,51 +172,270 @@ def main():
     
     parser.add_argument("--num_task_test", default=3, type=int,
                         help="Total number of tasks for testing")
+
+    parser.add_argument("--seed", default=42, type=int,
+                        help="Seed of the task sampler, epoch e draws its tasks with seed + e")
+
+    parser.add_argument("--token_cache", default=None, type=str,
+                        help="Path of the persistent token id cache, None to keep it in memory only")
+
+    parser.add_argument("--token_cache_size", default=1000000, type=int,
+                        help="Maximum number of texts in the token id cache, least recently used are evicted")
     
-    args = parser.parse_args()
+    parser.add_argument("--dynamic_padding", action="store_true",
+                        help="Trim every inner and query batch to its longest sequence instead of max_seq_length")
+
+    parser.add_argument("--length_bucketing", action="store_true",
+                        help="Batch support sets by length, so that trimmed inner batches carry little padding")
+
+    parser.add_argument("--num_workers", default=0, type=int,
+                        help="Worker processes preparing task batches in the background, 0 to build them on the training thread")
+
+    parser.add_argument("--prefetch_depth", default=2, type=int,
+                        help="Number of task batches each worker prepares ahead")
+
+    parser.add_argument("--local_rank", default=-1, type=int,
+                        help="For distributed training: local_rank, set by torch.distributed.launch")
+
+    parser.add_argument("--dist_backend", default='gloo', type=str,
+                        help="Backend of the process group in distributed training")
+
+    parser.add_argument("--learner", default='reptile', type=str, choices=['reptile', 'maml', 'maml_functional'],
+                        help="Meta learner: reptile, first-order maml, or first-order maml adapting the tasks of a batch together (vmap)")
+
+    parser.add_argument("--freeze_depth", default=0, type=int,
+                        help="maml only: number of lower encoder layers (with the embeddings) not adapted in the inner loop, their hidden states are computed once per task")
+
+    parser.add_argument("--bf16", action="store_true",
+                        help="maml and reptile: bfloat16 autocast of the inner and query forward passes (fp32 weights)")
+
+    parser.add_argument("--bf16_compare", action="store_true",
+                        help="With --bf16, repeat every test pass in fp32 to report the accuracy delta and speedup of bf16")
+
+    parser.add_argument("--inner_loss_tolerance", default=0.0, type=float,
+                        help="maml and reptile: stop adapting to a task once an inner epoch lowers the mean support loss by less than this, 0 to disable")
+
+    parser.add_argument("--inner_grad_norm", default=0.0, type=float,
+                        help="maml and reptile: stop adapting to a task once the mean gradient norm of an inner epoch is below this, 0 to disable")
+
+    parser.add_argument("--query_chunk_size", default=0, type=int,
+                        help="maml and reptile: run the query pass (and its backward) in chunks of this many examples, 0 for one batch")
+
+    parser.add_argument("--reptile_update", default='adam', type=str, choices=['adam', 'interpolate'],
+                        help="Reptile outer step: Adam along meta - mean adapted weights, or meta += epsilon * (mean adapted - meta)")
+
+    parser.add_argument("--reptile_epsilon", default=0.1, type=float,
+                        help="Interpolation step size of --reptile_update interpolate")
+
+    parser.add_argument("--stream_tasks", action="store_true",
+                        help="Draw training tasks lazily from an unbounded stream instead of rebuilding a MetaTask every epoch")
+
+    parser.add_argument("--second_order", action="store_true",
+                        help="maml_functional only: backpropagate the query loss through the inner loop (SGD inner steps)")
+
+    parser.add_argument("--second_order_horizon", default=0, type=int,
+                        help="Number of last inner steps differentiated through in second order mode, 0 for all")
+
+    parser.add_argument("--second_order_inner_lr", default=1e-3, type=float,
+                        help="Learning rate of the SGD inner steps in second order mode (--inner_update_lr is tuned for the Adam inner steps)")
+
+    parser.add_argument("--checkpoint_activations", action="store_true",
+                        help="Recompute encoder layers and inner step segments in backward to bound second order memory")
+
+    parser.add_argument("--target_acc", default=None, type=float,
+                        help="Stop once the test accuracy reaches this value and report the wall-clock time it took")
+
+    parser.add_argument("--async_eval_workers", default=0, type=int,
+                        help="Processes adapting to the test tasks from snapshots of the meta weights while training goes on, 0 to test on the training process")
+
+    parser.add_argument("--async_eval_snapshot", default='shm', type=str, choices=['shm', 'checkpoint'],
+                        help="How meta weights reach the evaluation processes: shared memory buffers or state_dict files in --async_eval_dir")
+
+    parser.add_argument("--async_eval_dir", default='.', type=str,
+                        help="Directory of the snapshot files of --async_eval_snapshot checkpoint")
+
+    parser.add_argument("--async_eval_threads", default=0, type=int,
+                        help="Torch threads of every evaluation process, 0 for the torch default")
+
+    parser.add_argument("--weights_cache", default=None, type=str,
+                        help="Directory caching the pretrained weights (memory-mapped, shared by concurrent runs) and tokenizer of --bert_model, None to load them with from_pretrained")
+
+    parser.add_argument("--profile", default=None, type=str,
+                        help="Write wall time, calls and memory of every phase as one JSON line per outer step to this file ('-' for stdout)")
+
+    parser.add_argument("--profile_trace_dir", default=None, type=str,
+                        help="With --profile, also record a torch.profiler chrome trace of --profile_trace_steps into this directory")
+
+    parser.add_argument("--profile_trace_steps", default='2:4', type=str,
+                        help="Outer steps first:last+1 of the torch.profiler trace")
+
+    parser.add_argument("--verbosity", default=STEP, type=int, choices=[0, 1, 2, 3],
+                        help="Metrics logged: 0 none, 1 outer steps and tests, 2 also every adapted task, 3 also every inner epoch")
+
+    parser.add_argument("--metrics_output", default='-', type=str,
+                        help="File the metrics are appended to, '-' for stdout")
+
+    parser.add_argument("--metrics_format", default=None, type=str, choices=FORMATS,
+                        help="Format of the metrics, by default csv for a .csv file, jsonl for other files and text for stdout")
+
+    parser.add_argument("--metrics_flush_interval", default=5.0, type=float,
+                        help="Seconds between writes of the buffered metrics, which are read back from the device by a background thread")
+
+    parser.add_argument("--ckpt_dir", default=None, type=str,
+                        help="Directory of the resumable checkpoints (meta weights, outer optimizer, RNG states, sampler position), None to not checkpoint")
+
+    parser.add_argument("--ckpt_every", default=100, type=int,
+                        help="Checkpoint every this many outer steps")
+
+    parser.add_argument("--ckpt_keyframe_every", default=0, type=int,
+                        help="Write a full checkpoint every this many checkpoints, the others are deltas against it; 0 for deltas against the pretrained weights")
+
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue from the last checkpoint of --ckpt_dir")
+
+    return parser
+
+def main():
+
+    args = get_parser().parse_args()
+    if args.ckpt_dir is not None and not args.resume and list_checkpoints(args.ckpt_dir):
+        # a new run would replace the keyframe the deltas of the existing checkpoints refer to
+        raise ValueError("--ckpt_dir {} already holds checkpoints, pass --resume to continue from them".format(args.ckpt_dir))
+    init_distributed(args)
+    rank, world_size = get_rank(), get_world_size()
+    # the records of rank 0 cover all ranks (accuracies are averaged over ranks)
+    sink.configure(args.metrics_output, args.verbosity if rank == 0 else QUIET, args.metrics_format,
+                   args.metrics_flush_interval)
     
     reviews = json.load(open(args.data))
     low_resource_domains = ["office_products", "automotive", "computer_&_video_games"]
 
     train_examples = [r for r in reviews if r['domain'] not in low_resource_domains]
     test_examples = [r for r in reviews if r['domain'] in low_resource_domains]
-    print(len(train_examples), len(test_examples))
+    log(STEP, 'data', train_examples = len(train_examples), test_examples = len(test_examples))
 
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case = True)
-    learner = Learner(args)
+    tokenizer = load_tokenizer(args.bert_model, args.weights_cache, do_lower_case = True)
+    learner = importlib.import_module(args.learner).Learner(args)
+    if args.profile is not None and rank == 0:
+        profiler.configure(args.profile, learner.device, args.profile_trace_dir,
+                           [int(n) for n in args.profile_trace_steps.split(':')])
+    token_cache = TokenCache(args.token_cache, max_entries = args.token_cache_size, namespace = args.bert_model)
     
+    train_index = DomainIndex(train_examples)
     test = MetaTask(test_examples, num_task = args.num_task_test, k_support=args.k_spt, 
-                    k_query=args.k_qry, tokenizer = tokenizer)
+                    k_query=args.k_qry, tokenizer = tokenizer, seed = args.seed,
+                    token_cache = token_cache)
 
     global_step = 0
-    for epoch in range(args.epoch):
+    checkpoint = latest_checkpoint(args.ckpt_dir) if args.resume else None
+    if checkpoint is not None:
+        # weights and tensors are read from the checkpoint files one at a time
+        state = load_training_state(checkpoint, learner.model, learner.outer_optimizer)
+        global_step = state['global_step']
+        log(STEP, 'resume', path = checkpoint.path, global_step = global_step)
+
+    if args.stream_tasks:
+        stream = TaskStream(train_examples, k_support=args.k_spt, k_query=args.k_qry, tokenizer = tokenizer,
+                            batch_size = args.outer_batch_size, domain_index = train_index, seed = args.seed,
+                            token_cache = token_cache, rank = rank, world_size = world_size)
+        if checkpoint is not None:
+            stream.load_state_dict(state['sampler'])
+        batches = stream_task_batches(args, stream, token_cache, rank)
+    else:
+        batches = epoch_task_batches(args, train_examples, train_index, tokenizer, token_cache, rank, world_size,
+                                     start_step = global_step)
 
-        train = MetaTask(train_examples, num_task = args.num_task_train, k_support=args.k_spt, 
-                         k_query=args.k_qry, tokenizer = tokenizer)
+    writer = None
+    saved_step = global_step
+    if args.ckpt_dir is not None and rank == 0:
+        # every rank holds the same meta weights, rank 0 writes them
+        writer = CheckpointWriter(args.ckpt_dir, keyframe_every = args.ckpt_keyframe_every)
+        if checkpoint is None:
+            # the pretrained weights, the base of the following deltas
+            save_training_state(writer, 0, learner.model, learner.outer_optimizer, global_step = 0,
+                                sampler = stream.state_dict() if args.stream_tasks else None)
 
-        db = create_batch_of_tasks(train, is_shuffle = True, batch_size = args.outer_batch_size)
+    early_stopping = args.inner_loss_tolerance > 0 or args.inner_grad_norm > 0
+    evaluator = None
+    if args.async_eval_workers > 0 and rank == 0:
+        # the evaluation processes test on all tasks, the other ranks only keep training
+        evaluator = AsyncEvaluator(args, test, learner.model, num_workers = args.async_eval_workers,
+                                   snapshot = args.async_eval_snapshot, snapshot_dir = args.async_eval_dir,
+                                   num_threads = args.async_eval_threads)
+    train_inner_steps, train_inner_cap = 0, 0
 
-        for step, task_batch in enumerate(db):
+    start_time = time.time()
+    for step, task_batch in profiler.iterate(batches, 'task_batch'):
 
+        with phase('learner'):
             acc = learner(task_batch)
+        train_inner_steps += sum(getattr(learner, 'inner_steps_used', []))
+        train_inner_cap   += len(task_batch) * args.inner_update_step
+
+        log(STEP, 'train', step = step, global_step = global_step, training_acc = acc)
+
+        if args.async_eval_workers > 0:
+            if evaluator is not None:
+                with phase('eval_snapshot'):
+                    submitted = global_step % 20 != 0 or evaluator.submit(global_step, time.time() - start_time)
+                if not submitted:
+                    log(STEP, 'test_skipped', step = step, global_step = global_step, reason = 'all evaluation processes busy')
+                if report_async_results(evaluator.poll(), args.target_acc, world_size):
+                    # the weights include this outer step
+                    global_step += 1
+                    break
+
+        elif global_step % 20 == 0:
+            test_start = time.time()
+            with phase('test'):
+                acc_test, test_inner_steps = test_accuracy(learner, test, rank, world_size)
+            test_time = time.time() - test_start
+
+            elapsed = time.time() - start_time
+            record = dict(step = step, global_step = global_step, test_acc = acc_test, elapsed = elapsed)
+            if early_stopping:
+                test_inner_cap = len(range(rank, len(test), world_size)) * args.inner_update_step_eval
+                record.update(train_inner_steps = train_inner_steps, train_inner_cap = train_inner_cap,
+                              test_inner_steps = test_inner_steps, test_inner_cap = test_inner_cap)
+
+            if args.bf16 and args.bf16_compare:
+                # same test tasks and seed in fp32, for the accuracy delta and speedup of bf16
+                learner.bf16 = False
+                test_start = time.time()
+                with phase('test_fp32'):
+                    acc_fp32, _ = test_accuracy(learner, test, rank, world_size)
+                fp32_time = time.time() - test_start
+                learner.bf16 = True
+                start_time += fp32_time
+                record.update(bf16_acc_delta = acc_test - acc_fp32, bf16_speedup = fp32_time / test_time)
+            log(STEP, 'test', **record)
 
-            print('Step:', step, '\ttraining Acc:', acc)
+            random_seed(int(time.time() % 10))
 
-            if global_step % 20 == 0:
-                random_seed(123)
-                print("\n-----------------Testing Mode-----------------\n")
-                db_test = create_batch_of_tasks(test, is_shuffle = False, batch_size = 1)
-                acc_all_test = []
+            if args.target_acc is not None and acc_test >= args.target_acc:
+                log(STEP, 'target_reached', target_acc = args.target_acc, outer_steps = global_step + 1, elapsed = elapsed)
+                global_step += 1
+                break
 
-                for test_batch in db_test:
-                    acc = learner(test_batch, training = False)
-                    acc_all_test.append(acc)
+        if writer is not None and (global_step + 1) % args.ckpt_every == 0:
+            with phase('checkpoint'):
+                save_training_state(writer, global_step + 1, learner.model, learner.outer_optimizer, global_step = global_step + 1,
+                                    sampler = stream.state_dict() if args.stream_tasks else None)
+            saved_step = global_step + 1
 
-                print('Step:', step, 'Test F1:', np.mean(acc_all_test))
+        profiler.step(global_step, training_acc = acc)
+        global_step += 1
 
-                random_seed(int(time.time() % 10))
+    if writer is not None:
+        if saved_step != global_step:
+            save_training_state(writer, global_step, learner.model, learner.outer_optimizer, global_step = global_step,
+                                sampler = stream.state_dict() if args.stream_tasks else None)
+        writer.close()
 
-            global_step += 1
+    if evaluator is not None:
+        report_async_results(evaluator.close(), args.target_acc, world_size)
+    profiler.close()
+    sink.close()
             
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,23 +3,44 @@ from torch.nn import functional as F
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler
 from torch.optim import Adam
 from torch.nn import CrossEntropyLoss
-from transformers import BertForSequenceClassification
+from fast_startup import load_pretrained
 from copy import deepcopy
-import gc
 import torch
-from sklearn.metrics import accuracy_score
 import numpy as np
+from batching import support_dataloader, trim_batch
+from distributed import broadcast_parameters, all_reduce_, mean_over_ranks
+from flat_params import flat_buffer, flat_views
+from precision import autocast
+from metrics import accuracy
+from early_stopping import InnerLoopStopper, grad_norm
+from profiling import phase
+from metrics_sink import log, enabled, TASK, INNER
+from functional_forward_bert import functional_embeeding, functional_layer, functional_pooler, functional_classifier
 
 class Learner(nn.Module):
     """
     Meta Learner
+
+    With args.freeze_depth > 0 the inner loop only adapts the encoder layers above freeze_depth, the
+    pooler and the classifier. The hidden states of the frozen embeddings and lower layers are computed
+    once per task (without dropout) and reused by every inner epoch; the query pass still runs through
+    the whole model, so every meta weight gets its first order gradient.
+
+    With args.bf16 the forward passes of the inner steps and of the query run under bf16 autocast,
+    weights, gradients and the meta-gradient accumulator stay fp32.
     """
     def __init__(self, args):
         """
         :param args:
         """
         super(Learner, self).__init__()
-        
+
+        # options of maml_functional.Learner that are not implemented here
+        unsupported = [name for name in ('second_order', 'second_order_horizon', 'checkpoint_activations')
+                       if getattr(args, name, None)]
+        if unsupported:
+            raise ValueError("--learner maml does not support --{}".format(', --'.join(unsupported)))
+
         self.num_labels = args.num_labels
         self.outer_batch_size = args.outer_batch_size
         self.inner_batch_size = args.inner_batch_size
@@ -28,14 +49,106 @@ class Learner(nn.Module):
         self.inner_update_step = args.inner_update_step
         self.inner_update_step_eval = args.inner_update_step_eval
         self.bert_model = args.bert_model
+        self.dynamic_padding  = args.dynamic_padding
+        self.length_bucketing = args.length_bucketing
+        self.freeze_depth     = args.freeze_depth
+        self.bf16             = args.bf16
+        self.query_chunk_size = args.query_chunk_size
+        self.stopper = InnerLoopStopper(args.inner_loss_tolerance, args.inner_grad_norm)
+        # inner epochs run for every task of the last forward call
+        self.inner_steps_used = []
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if args.local_rank != -1 and torch.cuda.is_available():
+            self.device = torch.device('cuda', args.local_rank)
         
-        self.model = BertForSequenceClassification.from_pretrained(self.bert_model, num_labels = self.num_labels)
+        self.model = load_pretrained(self.bert_model, self.num_labels, args.weights_cache)
+        broadcast_parameters(self.model)
         self.outer_optimizer = Adam(self.model.parameters(), lr=self.outer_update_lr)
         self.model.train()
+        self.config = self.model.config
+
+        # Allocated once, reset in place from the meta weights for every task
+        self.fast_model = deepcopy(self.model).to(self.device)
+        frozen = ['bert.embeddings.'] + ['bert.encoder.layer.{}.'.format(i) for i in range(self.freeze_depth)] if self.freeze_depth else []
+        adapted_params = [params for name, params in self.fast_model.named_parameters()
+                          if not any(name.startswith(prefix) for prefix in frozen)]
+        self.inner_optimizer = Adam(adapted_params, lr=self.inner_update_lr)
+
+        # Query gradients of all tasks are summed into one flat buffer on the compute device, whose
+        # views (through a single host copy when the meta model lives elsewhere) are the meta gradients
+        meta_params = list(self.model.parameters())
+        self.meta_grad = flat_buffer(meta_params, device=self.device)
+        self.meta_grad_views = flat_views(self.meta_grad, meta_params)
+        if meta_params[0].device == self.device:
+            self.meta_grad_host = self.meta_grad
+        else:
+            self.meta_grad_host = flat_buffer(meta_params).pin_memory()
+        self.meta_grad_host_views = flat_views(self.meta_grad_host, meta_params)
+
+    def reset_fast_model(self):
+        """
+        Copy the meta weights into the fast model and zero the inner optimizer state,
+        which is the state of a newly created Adam.
+        """
+        with torch.no_grad():
+            for fast, meta in zip(self.fast_model.state_dict().values(), self.model.state_dict().values()):
+                fast.copy_(meta)
+        for state in self.inner_optimizer.state.values():
+            for key, value in state.items():
+                if torch.is_tensor(value):
+                    value.zero_()
+                else:
+                    state[key] = 0
+        self.fast_model.zero_grad(set_to_none=False)
+
+    def extended_attention_mask(self, attention_mask, dtype):
+        return (1.0 - attention_mask[:, None, None, :].to(dtype)) * -10000.0
+
+    def frozen_prefix(self, dataset, requires_grad = False):
+        """
+        Hidden states of a dataset after the frozen embeddings and lower freeze_depth encoder layers of
+        the fast model, computed without dropout so that they can be reused for every inner epoch.
+        :return: TensorDataset(hidden_states (on the device), attention_mask, segment_ids, label_ids)
+        """
+        tensors = dataset.tensors
+        if self.dynamic_padding:
+            tensors = trim_batch(tensors)
+        input_ids, attention_mask, segment_ids, label_id = tensors
+        fast_weights = dict(self.fast_model.named_parameters())
+
+        all_hidden_states = []
+        with torch.set_grad_enabled(requires_grad), autocast(self.device, self.bf16):
+            for start in range(0, len(input_ids), self.inner_batch_size):
+                batch = tuple(t[start:start + self.inner_batch_size].to(self.device)
+                              for t in (input_ids, attention_mask, segment_ids))
+                hidden_states = functional_embeeding(fast_weights, self.config, batch[0], None, batch[2], is_train = False)
+                mask = self.extended_attention_mask(batch[1], hidden_states.dtype)
+                for i in range(0,self.freeze_depth):
+                    hidden_states = functional_layer(fast_weights, self.config, str(i), hidden_states, mask,
+                                                     None, None, None, is_train = False)
+                all_hidden_states.append(hidden_states)
+        return TensorDataset(torch.cat(all_hidden_states), attention_mask, segment_ids, label_id)
+
+    def adapted_forward(self, hidden_states, attention_mask, labels = None):
+        """
+        Upper encoder layers, pooler and classifier of the fast model on frozen prefix hidden states,
+        returns (loss, logits) like BertForSequenceClassification
+        """
+        fast_weights = dict(self.fast_model.named_parameters())
+        is_train = self.fast_model.training
+        mask = self.extended_attention_mask(attention_mask, hidden_states.dtype)
+        for i in range(self.freeze_depth, self.config.num_hidden_layers):
+            hidden_states = functional_layer(fast_weights, self.config, str(i), hidden_states, mask,
+                                             None, None, None, is_train)
+        pooled_output = functional_pooler(fast_weights, self.config, hidden_states)
+        return functional_classifier(fast_weights, self.config, pooled_output, labels, is_train)
 
     def forward(self, batch_tasks, training = True):
         """
+        In distributed mode batch_tasks is the share of the outer batch of this rank (possibly empty),
+        the meta-gradient and the returned accuracy are averaged over the tasks of all ranks.
+        The mean query accuracy is returned as a 0-d tensor, left on the device.
+
         batch = [(support TensorDataset, query TensorDataset),
                  (support TensorDataset, query TensorDataset),
                  (support TensorDataset, query TensorDataset),
@@ -44,81 +157,127 @@ class Learner(nn.Module):
         # support = TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)
         """
         task_accs = []
-        sum_gradients = []
-        num_task = len(batch_tasks)
         num_inner_update_step = self.inner_update_step if training else self.inner_update_step_eval
+        self.inner_steps_used = []
 
         for task_id, task in enumerate(batch_tasks):
             support = task[0]
             query   = task[1]
             
-            fast_model = deepcopy(self.model)
-            fast_model.to(self.device)
-            support_dataloader = DataLoader(support, sampler=RandomSampler(support),
-                                            batch_size=self.inner_batch_size)
+            with phase('reset_fast_model'):
+                self.reset_fast_model()
+            fast_model = self.fast_model
+            inner_optimizer = self.inner_optimizer
+            # fixed padding width, before frozen_prefix trims the support set
+            fixed_width = support.tensors[1].size(1)
+            if self.freeze_depth:
+                with phase('frozen_prefix'):
+                    support = self.frozen_prefix(support)
+            support_loader = support_dataloader(support, self.inner_batch_size, self.length_bucketing)
             
-            inner_optimizer = Adam(fast_model.parameters(), lr=self.inner_update_lr)
             fast_model.train()
             
-            print('----Task',task_id, '----')
+            inner_tokens, fixed_tokens = 0, 0
+            self.stopper.reset()
+            inner_epochs = 0
             for i in range(0,num_inner_update_step):
-                all_loss = []
-                for inner_step, batch in enumerate(support_dataloader):
+                inner_epochs += 1
+                all_loss, all_grad_norm = [], []
+                for inner_step, batch in enumerate(support_loader):
                     
-                    batch = tuple(t.to(self.device) for t in batch)
+                    fixed_tokens += len(batch[1]) * fixed_width
+                    if self.dynamic_padding:
+                        batch = trim_batch(batch)
+                    inner_tokens += batch[1].numel()
+                    with phase('to_device'):
+                        batch = tuple(t.to(self.device) for t in batch)
                     input_ids, attention_mask, segment_ids, label_id = batch
-                    outputs = fast_model(input_ids, attention_mask, segment_ids, labels = label_id)
+                    with phase('inner_forward'), autocast(self.device, self.bf16):
+                        if self.freeze_depth:
+                            # input_ids holds the cached hidden states of the frozen layers
+                            outputs = self.adapted_forward(input_ids, attention_mask, labels = label_id)
+                        else:
+                            outputs = fast_model(input_ids, attention_mask, segment_ids, labels = label_id)
                     
                     loss = outputs[0]              
-                    loss.backward()
-                    inner_optimizer.step()
-                    inner_optimizer.zero_grad()
+                    with phase('inner_backward'):
+                        loss.backward()
+                    if self.stopper.grad_norm_threshold > 0:
+                        all_grad_norm.append(grad_norm(inner_optimizer.param_groups[0]['params']))
+                    with phase('inner_step'):
+                        inner_optimizer.step()
+                        inner_optimizer.zero_grad(set_to_none=False)
                     
-                    all_loss.append(loss.item())
+                    all_loss.append(loss.detach())
                 
-                if i % 4 == 0:
-                    print("Inner Loss: ", np.mean(all_loss))
-
-            query_dataloader = DataLoader(query, sampler=None, batch_size=len(query))
-            query_batch = iter(query_dataloader).next()
-            query_batch = tuple(t.to(self.device) for t in query_batch)
-            q_input_ids, q_attention_mask, q_segment_ids, q_label_id = query_batch
-            q_outputs = fast_model(q_input_ids, q_attention_mask, q_segment_ids, labels = q_label_id)
-            
-            if training:
-                q_loss = q_outputs[0]
-                q_loss.backward()
-                fast_model.to(torch.device('cpu'))
-                for i, params in enumerate(fast_model.parameters()):
-                    if task_id == 0:
-                        sum_gradients.append(deepcopy(params.grad))
+                if enabled(INNER):
+                    log(INNER, 'inner_loss', task = task_id, epoch = i, loss = torch.stack(all_loss).mean())
+
+                if self.stopper.enabled and self.stopper.converged(all_loss, all_grad_norm):
+                    break
+
+            self.inner_steps_used.append(inner_epochs)
+            if enabled(TASK):
+                record = {'task': task_id, 'inner_steps': inner_epochs}
+                if self.dynamic_padding:
+                    # inner tokens per step, trimmed and with fixed padding
+                    record['inner_tokens'] = inner_tokens / float(inner_epochs * len(support_loader))
+                    record['fixed_tokens'] = fixed_tokens / float(inner_epochs * len(support_loader))
+                log(TASK, 'task', **record)
+
+            # query pass in chunks of query_chunk_size examples, each chunk loss weighted by its share of
+            # the query set, so that the accumulated gradients are those of the mean loss over the set
+            all_q_logits, all_q_label_id = [], []
+            query_dataloader = DataLoader(query, sampler=None, batch_size=self.query_chunk_size or len(query))
+            for query_batch in query_dataloader:
+                with phase('query_forward'), torch.set_grad_enabled(training):
+                    if self.freeze_depth:
+                        # recomputed with autograd in training, so that the frozen layers get their meta-gradient
+                        q_input_ids, q_attention_mask, q_segment_ids, q_label_id = self.frozen_prefix(TensorDataset(*query_batch), training).tensors
+                        q_attention_mask, q_label_id = q_attention_mask.to(self.device), q_label_id.to(self.device)
+                        with autocast(self.device, self.bf16):
+                            q_outputs = self.adapted_forward(q_input_ids, q_attention_mask, labels = q_label_id)
                     else:
-                        sum_gradients[i] += deepcopy(params.grad)
+                        if self.dynamic_padding:
+                            query_batch = trim_batch(query_batch)
+                        query_batch = tuple(t.to(self.device) for t in query_batch)
+                        q_input_ids, q_attention_mask, q_segment_ids, q_label_id = query_batch
+                        with autocast(self.device, self.bf16):
+                            q_outputs = fast_model(q_input_ids, q_attention_mask, q_segment_ids, labels = q_label_id)
 
-            q_logits = F.softmax(q_outputs[1],dim=1)
-            pre_label_id = torch.argmax(q_logits,dim=1)
-            pre_label_id = pre_label_id.detach().cpu().numpy().tolist()
-            q_label_id = q_label_id.detach().cpu().numpy().tolist()
-            
-            acc = accuracy_score(pre_label_id,q_label_id)
-            task_accs.append(acc)
-            
-            del fast_model, inner_optimizer
-            torch.cuda.empty_cache()
+                if training:
+                    q_loss = q_outputs[0] * (len(q_label_id) / float(len(query)))
+                    with phase('query_backward'):
+                        q_loss.backward()
+
+                all_q_logits.append(q_outputs[1].detach())
+                all_q_label_id.append(q_label_id)
+
+            if training:
+                with phase('meta_grad'), torch.no_grad():
+                    for meta_grad, params in zip(self.meta_grad_views, fast_model.parameters()):
+                        meta_grad.add_(params.grad)
+
+            # kept on the device, read back once for all tasks
+            task_accs.append(accuracy(torch.cat(all_q_logits), torch.cat(all_q_label_id)))
         
+        # Mean accuracy and task count over ranks, the accuracy is left on the device
+        acc, num_task = mean_over_ranks(task_accs)
+
         if training:
-            # Average gradient across tasks
-            for i in range(0,len(sum_gradients)):
-                sum_gradients[i] = sum_gradients[i] / float(num_task)
+            with phase('outer_update'):
+                # Sum over ranks (a rank without task adds zeros), then average gradient across tasks
+                all_reduce_(self.meta_grad)
+                if self.meta_grad_host is not self.meta_grad:
+                    self.meta_grad_host.copy_(self.meta_grad)
+                self.meta_grad_host.div_(num_task)
 
-            #Assign gradient for original model, then using optimizer to update its weights
-            for i, params in enumerate(self.model.parameters()):
-                params.grad = sum_gradients[i]
+                #Assign gradient for original model, then using optimizer to update its weights
+                for params, meta_grad in zip(self.model.parameters(), self.meta_grad_host_views):
+                    params.grad = meta_grad
 
-            self.outer_optimizer.step()
-            self.outer_optimizer.zero_grad()
-            
-            del sum_gradients
-            gc.collect()
+                self.outer_optimizer.step()
+                self.outer_optimizer.zero_grad()
+                self.meta_grad.zero_()
         
-        return np.mean(task_accs)
\ No newline at end of file
+        return acc
\ No newline at end of file
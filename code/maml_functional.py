@@ -0,0 +1,312 @@
+from torch import nn
+from torch.optim import Adam
+from torch.func import vmap, grad
+from fast_startup import load_pretrained
+from collections import OrderedDict
+import math
+import torch
+import numpy as np
+from distributed import broadcast_parameters, all_reduce_, mean_over_ranks
+from flat_params import flat_buffer, flat_views
+from metrics import accuracy
+from profiling import phase
+from metrics_sink import log, enabled, TASK, INNER
+from functional_forward_bert import functional_bert_for_sequence_classification
+
+def leaf_weights(fast_weights):
+    return OrderedDict((name, weight.detach().requires_grad_()) for name, weight in fast_weights.items())
+
+class Learner(nn.Module):
+    """
+    Functional first-order MAML learner, adapting all tasks of an outer batch together.
+
+    The fast weights of the tasks are stacked along a leading task dimension and every inner step
+    runs vmap(grad(loss)) of functional_bert over them, so each layer is one batched GEMM over
+    all tasks instead of one small GEMM per task. Inner updates are the Adam updates of
+    maml.Learner, applied to all tasks at once. Requires torch >= 2.0 (torch.func).
+
+    With args.second_order the tasks are adapted one after the other with differentiable SGD steps
+    (learning rate args.second_order_inner_lr) and the query loss is backpropagated through the
+    inner loop (full MAML, or truncated to the last second_order_horizon inner steps). With
+    args.checkpoint_activations the differentiated inner steps are recomputed in backward by
+    segments of ~sqrt(horizon) steps, so the memory of the second order graph grows with the square
+    root of the horizon, and the encoder layers of the first order passes are checkpointed.
+    """
+    def __init__(self, args):
+        """
+        :param args:
+        """
+        super(Learner, self).__init__()
+
+        # options of maml.Learner that are not implemented here
+        unsupported = [name for name in ('bf16', 'freeze_depth', 'query_chunk_size', 'length_bucketing',
+                                         'inner_loss_tolerance', 'inner_grad_norm') if getattr(args, name, None)]
+        if unsupported:
+            raise ValueError("--learner maml_functional does not support --{}".format(', --'.join(unsupported)))
+
+        self.num_labels = args.num_labels
+        self.outer_batch_size = args.outer_batch_size
+        self.inner_batch_size = args.inner_batch_size
+        self.outer_update_lr  = args.outer_update_lr
+        self.inner_update_lr  = args.inner_update_lr
+        self.inner_update_step = args.inner_update_step
+        self.inner_update_step_eval = args.inner_update_step_eval
+        self.bert_model = args.bert_model
+        self.dynamic_padding = args.dynamic_padding
+        self.second_order = args.second_order
+        self.second_order_horizon = args.second_order_horizon
+        self.second_order_inner_lr = args.second_order_inner_lr
+        self.checkpoint_activations = args.checkpoint_activations
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if args.local_rank != -1 and torch.cuda.is_available():
+            self.device = torch.device('cuda', args.local_rank)
+
+        self.model = load_pretrained(self.bert_model, self.num_labels, args.weights_cache)
+        broadcast_parameters(self.model)
+        self.model.to(self.device)
+        self.config = self.model.config
+        self.outer_optimizer = Adam(self.model.parameters(), lr=self.outer_update_lr)
+        self.model.train()
+
+        meta_params = list(self.model.parameters())
+        self.meta_grad = flat_buffer(meta_params)
+        self.meta_grad_views = flat_views(self.meta_grad, meta_params)
+
+        # per task gradient (and logits) of the loss w.r.t. the stacked fast weights, dropout drawn per task
+        self.batched_grad = vmap(grad(self.loss, has_aux=True), randomness='different')
+        self.batched_logits = vmap(self.logits, randomness='different')
+
+    def loss(self, fast_weights, input_ids, attention_mask, segment_ids, label_id):
+        loss, logits = functional_bert_for_sequence_classification(fast_weights, self.config, input_ids, attention_mask,
+                                                                   segment_ids, labels = label_id, is_train = True)
+        return loss, logits
+
+    def logits(self, fast_weights, input_ids, attention_mask, segment_ids):
+        return functional_bert_for_sequence_classification(fast_weights, self.config, input_ids, attention_mask,
+                                                           segment_ids, is_train = True)[0]
+
+    def sgd_step(self, fast_weights, batch, create_graph = False):
+        """
+        One SGD step on an inner batch, differentiable w.r.t. fast_weights when create_graph.
+        :return: (new fast weights, detached loss)
+        """
+        input_ids, attention_mask, segment_ids, label_id = batch
+        loss = functional_bert_for_sequence_classification(fast_weights, self.config, input_ids, attention_mask,
+                                                           segment_ids, labels = label_id, is_train = True,
+                                                           checkpoint = self.checkpoint_activations and not create_graph)[0]
+        grads = torch.autograd.grad(loss, list(fast_weights.values()), create_graph = create_graph)
+        new_weights = OrderedDict((name, weight - self.second_order_inner_lr * g)
+                                  for (name, weight), g in zip(fast_weights.items(), grads))
+        return new_weights, loss.detach()
+
+    def sgd_steps(self, fast_weights, batches, create_graph = False):
+        """
+        SGD steps over a list of inner batches. Without create_graph every step starts from detached
+        weights and the result is detached, so no graph is kept across steps.
+        :return: (fast weights, list of detached losses)
+        """
+        losses = []
+        for batch in batches:
+            if not create_graph:
+                fast_weights = leaf_weights(fast_weights)
+            fast_weights, loss = self.sgd_step(fast_weights, batch, create_graph)
+            losses.append(loss)
+        if not create_graph:
+            fast_weights = OrderedDict((name, weight.detach()) for name, weight in fast_weights.items())
+        return fast_weights, losses
+
+    def rng_devices(self):
+        return [self.device] if self.device.type == 'cuda' else []
+
+    def get_rng_state(self):
+        return torch.get_rng_state(), [torch.cuda.get_rng_state(device) for device in self.rng_devices()]
+
+    def set_rng_state(self, state):
+        torch.set_rng_state(state[0])
+        for device, cuda_state in zip(self.rng_devices(), state[1]):
+            torch.cuda.set_rng_state(cuda_state, device)
+
+    def second_order_task(self, support, query, num_inner_update_step, training = True):
+        """
+        Adapt to one task with SGD and, in training, add the gradient of its query loss w.r.t. the
+        meta weights, backpropagated through the last second_order_horizon inner steps, to meta_grad.
+
+        The differentiated steps are split into segments. Only the input weights (and RNG state) of
+        every segment are kept on the way forward, then segments are recomputed with their second
+        order graph one at a time, last first, and the query gradient is carried back through them.
+        :return: query logits
+        """
+        support = [t.to(self.device) for t in support.tensors]
+        num_support = support[0].size(0)
+        batches = []
+        for i in range(0,num_inner_update_step):
+            order = torch.randperm(num_support).to(self.device)
+            batches += [self.trim(tuple(t[order[start:start + self.inner_batch_size]] for t in support))
+                        for start in range(0, num_support, self.inner_batch_size)]
+
+        horizon = len(batches) if self.second_order_horizon <= 0 else min(self.second_order_horizon, len(batches))
+        if not training:
+            horizon = 0
+        segment_size = int(math.ceil(math.sqrt(horizon))) if self.checkpoint_activations else horizon
+        segments = [batches[start:start + segment_size] for start in range(len(batches) - horizon, len(batches), max(segment_size, 1))]
+        segments = segments or [[]]
+
+        # steps before the horizon are first order, the meta-gradient goes through them unchanged
+        fast_weights = OrderedDict((name, params.detach()) for name, params in self.model.named_parameters())
+        fast_weights, all_loss = self.sgd_steps(fast_weights, batches[:len(batches) - horizon])
+
+        boundaries = []
+        for segment in segments[:-1]:
+            boundaries.append((fast_weights, self.get_rng_state()))
+            fast_weights, losses = self.sgd_steps(fast_weights, segment)
+            all_loss += losses
+
+        inputs = leaf_weights(fast_weights)
+        fast_weights, losses = self.sgd_steps(inputs, segments[-1], create_graph = training)
+        all_loss += losses
+
+        if all_loss and enabled(INNER):
+            log(INNER, 'inner_loss', loss = torch.stack(all_loss).mean())
+
+        q_input_ids, q_attention_mask, q_segment_ids, q_label_id = self.trim(tuple(t.to(self.device) for t in query.tensors))
+        if not training:
+            with torch.no_grad():
+                return functional_bert_for_sequence_classification(fast_weights, self.config, q_input_ids, q_attention_mask,
+                                                                   q_segment_ids, is_train = True)[0]
+
+        q_loss, q_logits = functional_bert_for_sequence_classification(fast_weights, self.config, q_input_ids,
+                                                                       q_attention_mask, q_segment_ids,
+                                                                       labels = q_label_id, is_train = True,
+                                                                       checkpoint = self.checkpoint_activations)
+        adjoint = torch.autograd.grad(q_loss, list(inputs.values()))
+        del fast_weights, q_loss
+
+        for (weights, state), segment in zip(reversed(boundaries), reversed(segments[:-1])):
+            inputs = leaf_weights(weights)
+            with torch.random.fork_rng(devices = self.rng_devices()):
+                self.set_rng_state(state)
+                outputs, _ = self.sgd_steps(inputs, segment, create_graph = True)
+            adjoint = torch.autograd.grad(list(outputs.values()), list(inputs.values()), grad_outputs = adjoint)
+
+        with torch.no_grad():
+            for meta_grad, g in zip(self.meta_grad_views, adjoint):
+                meta_grad.add_(g)
+        return q_logits.detach()
+
+    def stack_sets(self, sets):
+        """
+        Stack the tensors of same-sized TensorDatasets along a new leading task dimension.
+        """
+        if len(set(len(s) for s in sets)) != 1:
+            raise ValueError("All tasks of an outer batch must have the same number of examples")
+        return [torch.stack(tensors).to(self.device) for tensors in zip(*(s.tensors for s in sets))]
+
+    def trim(self, batch):
+        if not self.dynamic_padding:
+            return batch
+        input_ids, attention_mask, segment_ids, label_id = batch
+        max_len = int(attention_mask.sum(-1).max())
+        return input_ids[..., :max_len], attention_mask[..., :max_len], segment_ids[..., :max_len], label_id
+
+    def inner_adam_step(self, fast_weights, grads, exp_avgs, exp_avg_sqs, step, betas=(0.9, 0.999), eps=1e-8):
+        """
+        torch.optim.Adam update (no weight decay) of the stacked fast weights, in place.
+        """
+        bias_correction1 = 1 - betas[0] ** step
+        bias_correction2 = 1 - betas[1] ** step
+        step_size = self.inner_update_lr / bias_correction1
+        for name, weight in fast_weights.items():
+            exp_avgs[name].mul_(betas[0]).add_(grads[name], alpha=1 - betas[0])
+            exp_avg_sqs[name].mul_(betas[1]).addcmul_(grads[name], grads[name], value=1 - betas[1])
+            denom = (exp_avg_sqs[name].sqrt() / math.sqrt(bias_correction2)).add_(eps)
+            weight.addcdiv_(exp_avgs[name], denom, value=-step_size)
+
+    def forward(self, batch_tasks, training = True):
+        """
+        The mean query accuracy is returned as a 0-d tensor, left on the device.
+
+        batch = [(support TensorDataset, query TensorDataset),
+                 (support TensorDataset, query TensorDataset),
+                 (support TensorDataset, query TensorDataset),
+                 (support TensorDataset, query TensorDataset)]
+
+        # support = TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)
+        """
+        num_inner_update_step = self.inner_update_step if training else self.inner_update_step_eval
+        task_accs = []
+
+        if batch_tasks and self.second_order:
+            for task_id, (support, query) in enumerate(batch_tasks):
+                log(TASK, 'task', task = task_id)
+                with phase('second_order_task'):
+                    q_logits = self.second_order_task(support, query, num_inner_update_step, training)
+                q_label_id = query.tensors[3].to(self.device)
+                task_accs.append(accuracy(q_logits, q_label_id))
+
+        elif batch_tasks:
+            num_task = len(batch_tasks)
+            with phase('stack_sets'):
+                support = self.stack_sets([task[0] for task in batch_tasks])
+                query   = self.stack_sets([task[1] for task in batch_tasks])
+            num_support = support[0].size(1)
+            task_ids = torch.arange(num_task, device=self.device)[:, None]
+
+            with phase('reset_fast_weights'), torch.no_grad():
+                fast_weights = {name: params.detach().unsqueeze(0).repeat(num_task, *[1] * params.dim())
+                                for name, params in self.model.named_parameters()}
+                exp_avgs    = {name: torch.zeros_like(weight) for name, weight in fast_weights.items()}
+                exp_avg_sqs = {name: torch.zeros_like(weight) for name, weight in fast_weights.items()}
+
+            step = 0
+            for i in range(0,num_inner_update_step):
+                # every task visits its support set in its own random order, inner batches are taken in lockstep
+                order = torch.stack([torch.randperm(num_support) for _ in range(num_task)]).to(self.device)
+                all_loss = []
+                for start in range(0, num_support, self.inner_batch_size):
+                    idx = order[:, start:start + self.inner_batch_size]
+                    batch = self.trim(tuple(t[task_ids, idx] for t in support))
+                    with phase('inner_grad'):
+                        grads, logits = self.batched_grad(fast_weights, *batch)
+
+                    step += 1
+                    with phase('inner_step'), torch.no_grad():
+                        self.inner_adam_step(fast_weights, grads, exp_avgs, exp_avg_sqs, step)
+                    all_loss.append(nn.functional.cross_entropy(logits.detach().flatten(0, 1), batch[3].flatten()))
+
+                if enabled(INNER):
+                    log(INNER, 'inner_loss', epoch = i, loss = torch.stack(all_loss).mean())
+
+            q_input_ids, q_attention_mask, q_segment_ids, q_label_id = self.trim(tuple(query))
+            if training:
+                # first order: query gradients at the adapted weights, summed over tasks
+                with phase('query_grad'):
+                    q_grads, q_logits = self.batched_grad(fast_weights, q_input_ids, q_attention_mask,
+                                                          q_segment_ids, q_label_id)
+                with phase('meta_grad'), torch.no_grad():
+                    for meta_grad, (name, _) in zip(self.meta_grad_views, self.model.named_parameters()):
+                        meta_grad.add_(q_grads[name].sum(0))
+            else:
+                with phase('query_forward'), torch.no_grad():
+                    q_logits = self.batched_logits(fast_weights, q_input_ids, q_attention_mask, q_segment_ids)
+
+            # accuracy of every task, kept on the device
+            task_accs = list((q_logits.argmax(-1) == q_label_id).double().mean(1).unbind())
+
+        # Mean accuracy and task count over ranks, the accuracy is left on the device
+        acc, num_task = mean_over_ranks(task_accs)
+
+        if training:
+            with phase('outer_update'):
+                # Sum over ranks (a rank without task adds zeros), then average gradient across tasks
+                all_reduce_(self.meta_grad)
+                self.meta_grad.div_(num_task)
+
+                #Assign gradient for original model, then using optimizer to update its weights
+                for params, meta_grad in zip(self.model.parameters(), self.meta_grad_views):
+                    params.grad = meta_grad
+
+                self.outer_optimizer.step()
+                self.outer_optimizer.zero_grad()
+                self.meta_grad.zero_()
+
+        return acc
@@ -0,0 +1,103 @@
+import torch
+
+# On-device GLUE metrics: predictions are accumulated into a confusion matrix (classification) or
+# kept as device tensors (regression) without reading anything back per batch, and all metrics of
+# a task are computed from them in one reduction with a single host transfer.
+
+TASK_METRICS = {'cola': 'mcc', 'mrpc': 'acc_and_f1', 'qqp': 'acc_and_f1', 'sts-b': 'pearson_and_spearman'}
+PRIMARY_METRICS = {'mcc': 'mcc', 'acc_and_f1': 'f1', 'pearson_and_spearman': 'pearson', 'acc': 'acc'}
+
+
+def primary_metric(task):
+    """
+    Name of the metric reported for a GLUE task (mcc for CoLA, f1 for MRPC/QQP, pearson for STS-B, acc otherwise)
+    """
+    return PRIMARY_METRICS[TASK_METRICS.get(task, 'acc')]
+
+
+def accuracy(logits, labels):
+    """
+    Accuracy of a batch of predictions, as a 0-d tensor on the device of logits
+    """
+    return (logits.argmax(-1) == labels).double().mean()
+
+
+def ranks(x):
+    """
+    1-based ranks of x, ties getting their average rank (as scipy.stats.rankdata)
+    """
+    sorted_x, order = torch.sort(x)
+    _, inverse, counts = torch.unique_consecutive(sorted_x, return_inverse=True, return_counts=True)
+    counts = counts.double()
+    average_rank = torch.cumsum(counts, 0) - (counts - 1) / 2
+    result = torch.empty_like(x, dtype=torch.float64)
+    result[order] = average_rank[inverse]
+    return result
+
+
+def pearson(x, y):
+    x, y = x - x.mean(), y - y.mean()
+    return (x * y).sum() / torch.sqrt((x * x).sum() * (y * y).sum())
+
+
+class StreamingMetrics(object):
+    """
+    Accumulates the predictions of any number of batches (and tasks) of one GLUE task on the device.
+    """
+    def __init__(self, task=None, num_labels=2, device='cpu'):
+        """
+        :param task: GLUE task name, selects the official metric, None for accuracy only
+        :param num_labels: number of classes, 1 for regression
+        """
+        self.task = task
+        self.metric = TASK_METRICS.get(task, 'acc')
+        self.regression = num_labels == 1 or self.metric == 'pearson_and_spearman'
+        self.num_labels = num_labels
+        self.device = torch.device(device)
+        self.reset()
+
+    def reset(self):
+        self.confusion = torch.zeros(self.num_labels, self.num_labels, dtype=torch.long, device=self.device)
+        self.predictions, self.labels = [], []
+
+    def update(self, logits, labels):
+        """
+        :param logits: (batch, num_labels) scores, or (batch,) / (batch, 1) predictions for regression
+        :param labels: (batch,) gold labels / scores
+        """
+        if self.regression:
+            self.predictions.append(logits.detach().reshape(-1).to(self.device, torch.float64))
+            self.labels.append(labels.detach().reshape(-1).to(self.device, torch.float64))
+            return
+        index = labels.to(self.device) * self.num_labels + logits.detach().argmax(-1).to(self.device)
+        self.confusion.view(-1).index_add_(0, index, torch.ones_like(index))
+
+    def compute(self):
+        """
+        :return: dict of metric name -> float, e.g. {'acc': .., 'f1': .., 'acc_and_f1': ..} for MRPC
+        """
+        if self.regression:
+            x, y = torch.cat(self.predictions), torch.cat(self.labels)
+            values = torch.stack([pearson(x, y), pearson(ranks(x), ranks(y))]).tolist()
+            return {'pearson': values[0], 'spearmanr': values[1], 'corr': sum(values) / 2}
+
+        confusion = self.confusion.double()
+        n = confusion.sum()
+        correct = confusion.trace()
+        true_sum, pred_sum = confusion.sum(1), confusion.sum(0)
+        tp, fp, fn = confusion[-1, -1], pred_sum[-1] - confusion[-1, -1], true_sum[-1] - confusion[-1, -1]
+        # matthews correlation in its multiclass form (as sklearn), f1 of the last (positive) class
+        cov_ytyp = correct * n - torch.dot(true_sum, pred_sum)
+        cov_ypyp = n * n - torch.dot(pred_sum, pred_sum)
+        cov_ytyt = n * n - torch.dot(true_sum, true_sum)
+        denominator = torch.sqrt(cov_ytyt * cov_ypyp)
+        acc, f1, mcc = torch.stack([correct / n.clamp(min=1),
+                                    2 * tp / (2 * tp + fp + fn).clamp(min=1),
+                                    torch.where(denominator > 0, cov_ytyp / denominator.clamp(min=1e-12),
+                                                torch.zeros_like(denominator))]).tolist()
+
+        if self.metric == 'mcc':
+            return {'mcc': mcc}
+        if self.metric == 'acc_and_f1':
+            return {'acc': acc, 'f1': f1, 'acc_and_f1': (acc + f1) / 2}
+        return {'acc': acc}
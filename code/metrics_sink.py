@@ -0,0 +1,174 @@
+import io
+import sys
+import csv
+import json
+import time
+import atexit
+import threading
+from collections import OrderedDict
+import torch
+
+# Buffered metrics of the training loop.
+#
+# Code reports a record with `log(level, event, name=value, ...)`. Values may be 0-d tensors left on
+# their device (losses, accuracies): logging only appends the record to a buffer, nothing is read
+# back or written on the calling thread. A background thread takes the buffer every flush_interval
+# seconds, reads all its tensors back with one transfer per device and writes the records as text
+# lines, JSON lines or CSV rows (record, time, event, name, value). Records above the verbosity are
+# dropped when logged, so the values they would need are best not computed at all:
+#
+#   if enabled(INNER):
+#       log(INNER, 'inner_loss', task=task_id, loss=torch.stack(all_loss).mean())
+
+QUIET, STEP, TASK, INNER = 0, 1, 2, 3
+FORMATS = ['text', 'jsonl', 'csv']
+
+
+def default_format(output):
+    """
+    Format of an output path: csv for .csv files, jsonl for other files, text for stdout ('-')
+    """
+    if output == '-':
+        return 'text'
+    return 'csv' if output.endswith('.csv') else 'jsonl'
+
+
+def format_value(value):
+    return '{:.4f}'.format(value) if isinstance(value, float) else str(value)
+
+
+class MetricsSink(object):
+
+    def __init__(self):
+        self.verbosity = STEP
+        self.output = None
+        self.format = 'text'
+        self.flush_interval = 5.0
+        self.records = []
+        self.num_records = 0
+        self.lock = threading.Lock()
+        # held while writing, flush() may run concurrently with the background thread
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.closed = False
+
+    def configure(self, output = '-', verbosity = STEP, format = None, flush_interval = 5.0):
+        """
+        :param output: file the records are appended to, '-' for stdout
+        :param verbosity: highest level logged: QUIET (nothing), STEP (outer steps and tests),
+                          TASK (every adapted task), INNER (every inner epoch)
+        :param format: 'text', 'jsonl' or 'csv', None for default_format(output)
+        :param flush_interval: seconds between writes of the buffered records
+        """
+        self.close()
+        self.verbosity = verbosity
+        self.format = format or default_format(output)
+        self.output = output
+        self.flush_interval = flush_interval
+        self.closed = False
+
+    def enabled(self, level):
+        return level <= self.verbosity
+
+    def log(self, level, event, **values):
+        """
+        Buffer a record of event if level is enabled; tensor values are read back when flushed.
+        """
+        if level > self.verbosity:
+            return
+        values = OrderedDict((name, value.detach() if torch.is_tensor(value) else value)
+                             for name, value in values.items())
+        with self.lock:
+            self.records.append((time.time(), event, values))
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        if self.output == '-' or self.output is None:
+            self.stream = sys.stdout
+        else:
+            self.stream = open(self.output, 'a', newline = '')
+        if self.format == 'csv':
+            self.csv_writer = csv.writer(self.stream)
+            if self.stream is sys.stdout or self.stream.tell() == 0:
+                self.csv_writer.writerow(['record', 'time', 'event', 'name', 'value'])
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.write()
+
+    @staticmethod
+    def read_back(records):
+        """
+        Replace the tensor values of records by Python numbers (lists for non-scalars),
+        stacking the scalars of every device into a single transfer
+        """
+        scalars = OrderedDict()
+        for _, _, values in records:
+            for name, value in values.items():
+                if torch.is_tensor(value):
+                    if value.numel() == 1:
+                        scalars.setdefault(value.device, []).append((values, name, value))
+                    else:
+                        values[name] = value.tolist()
+        for entries in scalars.values():
+            numbers = torch.stack([value.reshape(()).double() for _, _, value in entries]).tolist()
+            for (values, name, value), number in zip(entries, numbers):
+                values[name] = int(number) if not (value.is_floating_point() or value.is_complex()) else number
+
+    def write(self):
+        with self.write_lock:
+            with self.lock:
+                records, self.records = self.records, []
+            if not records:
+                return
+            self.read_back(records)
+            lines = io.StringIO()
+            for logged, event, values in records:
+                self.num_records += 1
+                if self.format == 'csv':
+                    for name, value in values.items():
+                        self.csv_writer.writerow([self.num_records, '{:.3f}'.format(logged), event, name, value])
+                elif self.format == 'jsonl':
+                    lines.write(json.dumps(dict({'record': self.num_records, 'time': logged, 'event': event}, **values)) + '\n')
+                else:
+                    lines.write('\t'.join([event] + ['{}: {}'.format(name, format_value(value))
+                                                     for name, value in values.items()]) + '\n')
+            self.stream.write(lines.getvalue())
+            self.stream.flush()
+
+    def flush(self):
+        """
+        Write the buffered records now (on the calling thread)
+        """
+        if self.thread is not None:
+            self.write()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.write()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+        self.thread = None
+        self.wakeup.clear()
+
+
+sink = MetricsSink()
+
+
+def log(level, event, **values):
+    sink.log(level, event, **values)
+
+
+def enabled(level):
+    return sink.enabled(level)
@@ -0,0 +1,16 @@
+import contextlib
+import torch
+
+# Opt-in bfloat16 autocast of forward passes. Parameters, gradients, optimizer states and the
+# meta-gradient / Reptile delta accumulators stay fp32: autocast only casts the inputs of matmuls
+# (and other bf16-safe ops) inside the context, and backward runs outside of it.
+
+
+def autocast(device, enabled=True):
+    """
+    bf16 autocast context for the device type of device, a no-op context when not enabled
+    (torch.autocast needs torch >= 1.10, bf16 on CPU a CPU with AVX512-BF16/AMX to be fast)
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
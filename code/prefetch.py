@@ -0,0 +1,82 @@
+import random
+import numpy as np
+import torch
+from collections import OrderedDict
+from torch.utils.data import DataLoader, get_worker_info
+
+
+def collate_tasks(batch):
+    """
+    Keep a batch of tasks as a list of (support TensorDataset, query TensorDataset), along with
+    the token ids the worker tokenized for it
+    """
+    token_cache = getattr(get_worker_info().dataset, 'token_cache', None)
+    return batch, (token_cache.take_pending() if token_cache is not None else OrderedDict())
+
+
+def seed_worker(worker_id):
+    """
+    Seed python and numpy RNGs of a worker from its torch seed (base_seed + worker_id),
+    which the DataLoader derives from its generator, so workers are deterministic.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def init_worker(worker_id):
+    """
+    Seed the worker and record the entries it adds to the token cache of its taskset
+    """
+    seed_worker(worker_id)
+    token_cache = getattr(get_worker_info().dataset, 'token_cache', None)
+    if token_cache is not None:
+        token_cache.pending = OrderedDict()
+
+
+def merge_token_ids(loader, token_cache):
+    """
+    Task batches of loader, merging the token ids tokenized by the workers into token_cache
+    """
+    for batch, entries in loader:
+        if token_cache is not None:
+            token_cache.merge(entries)
+        yield batch
+
+
+def prefetch_batch_of_tasks(taskset, batch_indices, num_workers = 2, queue_depth = 2, seed = None, token_cache = None):
+    """
+    Build batches of tasks on worker processes while the learner adapts on the current one.
+
+    Workers call taskset[idx] (tokenization and tensor building) and hand the finished
+    (support, query) TensorDatasets back through shared memory. Yields the same batches as
+    main.create_batch_of_tasks for the same batch_indices.
+    Workers look up their copy of the taskset's token cache (give the taskset token_cache.subset of
+    its texts, so only those entries are copied to the workers) and send the token ids of the texts
+    they tokenize back with the batch, to be merged into token_cache.
+    :param taskset: MetaTask
+    :param batch_indices: task indices of every outer batch, see main.batch_task_indices
+    :param num_workers: number of worker processes
+    :param queue_depth: number of batches each worker prepares ahead
+    :param seed: seed of the workers
+    :param token_cache: TokenCache of the main process, None to drop the token ids of the workers
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed if seed is not None else random.randrange(2**31))
+    loader = DataLoader(taskset, batch_sampler = batch_indices, collate_fn = collate_tasks,
+                        num_workers = num_workers, prefetch_factor = queue_depth, worker_init_fn = init_worker,
+                        generator = generator)
+    return merge_token_ids(loader, token_cache)
+
+
+def prefetch_task_stream(stream, num_workers = 2, queue_depth = 2, seed = None, token_cache = None):
+    """
+    Same as prefetch_batch_of_tasks for a task.TaskStream: worker w builds every num_workers-th
+    outer batch and the batches come back in stream order.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed if seed is not None else random.randrange(2**31))
+    loader = DataLoader(stream, batch_size = None, collate_fn = collate_tasks,
+                        num_workers = num_workers, prefetch_factor = queue_depth, worker_init_fn = init_worker,
+                        generator = generator)
+    return merge_token_ids(loader, token_cache)
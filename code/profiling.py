@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import contextlib
+import torch
+from metrics_sink import log, STEP
+
+# Per-phase profiling of the training loop.
+#
+# Code marks its phases with `with phase('name'):` (or the @profiled('name') decorator). While the
+# process-wide profiler is enabled, every phase adds its wall time, a call and its memory to the
+# summary of the current outer step, which main writes as one JSON line per step. On CUDA the memory
+# is the peak allocated since the start of the step. On CPU it is the peak RSS during the phase and
+# its growth over the RSS at the phase start: the kernel's high-water mark (VmHWM) is reset when a
+# phase starts, after folding the peak so far into the enclosing phases. Where it cannot be reset,
+# the RSS at the end of the phase stands in for its peak.
+# Nested phases are timed separately, so the phase times of a step can add up to more than its
+# time. Disabled (the default, and in worker processes) a phase is a shared no-op context.
+# Optionally a torch.profiler trace is recorded over a window of outer steps, with the phases
+# showing up as labelled ranges.
+
+NO_PHASE = contextlib.nullcontext()
+PAGE_SIZE = resource.getpagesize()
+
+
+class PhaseProfiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.device = torch.device('cpu')
+        self.trace_dir = None
+        self.trace_steps = None
+        self.trace = None
+        self.track_peak_rss = False
+        self.reset()
+
+    def configure(self, output = '-', device = 'cpu', trace_dir = None, trace_steps = None):
+        """
+        :param output: JSON lines file of the step summaries, '-' for stdout
+        :param device: device whose memory is reported (CUDA: max allocated since the start of the
+                       step; CPU: peak RSS of the phase); on CUDA phases synchronize the device
+        :param trace_dir: directory of the torch.profiler chrome trace, None for no trace
+        :param trace_steps: (first, last + 1) outer steps traced
+        """
+        self.enabled = True
+        self.output = sys.stdout if output == '-' else open(output, 'a')
+        self.device = torch.device(device)
+        self.track_peak_rss = self.device.type != 'cuda' and self.reset_peak_rss()
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        if trace_dir is not None:
+            os.makedirs(trace_dir, exist_ok = True)
+        if trace_dir is not None and trace_steps[0] == 0:
+            self.start_trace()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        elif self.track_peak_rss:
+            self.reset_peak_rss()
+        # running peak RSS of the step and of every open phase, innermost last
+        self.peaks = [0.0]
+        self.step_start = time.time()
+
+    def peak_memory_mb(self):
+        return torch.cuda.max_memory_allocated(self.device) / 2.0**20
+
+    def rss_mb(self):
+        """
+        Current resident set size of the process (its peak where /proc is not available)
+        """
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * PAGE_SIZE / 2.0**20
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    def peak_rss_mb(self):
+        """
+        Peak resident set size since the last reset_peak_rss
+        """
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+
+    def reset_peak_rss(self):
+        """
+        :return: False where the peak RSS cannot be reset (no Linux /proc)
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    def enter_peak(self):
+        if self.track_peak_rss:
+            self.peaks[-1] = max(self.peaks[-1], self.peak_rss_mb())
+            self.reset_peak_rss()
+        self.peaks.append(0.0)
+
+    def exit_peak(self):
+        peak = max(self.peaks.pop(), self.peak_rss_mb() if self.track_peak_rss else self.rss_mb())
+        self.peaks[-1] = max(self.peaks[-1], peak)
+        return peak
+
+    def step_memory(self):
+        if self.device.type == 'cuda':
+            return {'peak_memory_mb': self.peak_memory_mb()}
+        peak = max(self.peaks[0], self.peak_rss_mb() if self.track_peak_rss else self.rss_mb())
+        return {'peak_rss_mb': peak, 'rss_mb': self.rss_mb()}
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def phase(self, name):
+        return self.timed_phase(name) if self.enabled else NO_PHASE
+
+    @contextlib.contextmanager
+    def timed_phase(self, name):
+        self.synchronize()
+        cuda = self.device.type == 'cuda'
+        if not cuda:
+            start_rss = self.rss_mb()
+            self.enter_peak()
+        start = time.time()
+        try:
+            with torch.profiler.record_function(name) if self.trace is not None else NO_PHASE:
+                yield
+        finally:
+            if not cuda:
+                peak = self.exit_peak()
+        self.synchronize()
+        elapsed = time.time() - start
+        if cuda:
+            memory = {'peak_memory_mb': self.peak_memory_mb()}
+        else:
+            memory = {'peak_rss_mb': peak, 'peak_rss_growth_mb': peak - start_rss}
+
+        stats = self.phases.setdefault(name, dict({'time': 0.0, 'calls': 0}, **{key: 0.0 for key in memory}))
+        stats['time'] += elapsed
+        stats['calls'] += 1
+        for key, value in memory.items():
+            stats[key] = max(stats[key], value)
+
+    def iterate(self, iterable, name):
+        """
+        Yield the items of iterable, timing every next() as phase name
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, step, **extra):
+        """
+        Write the summary of outer step and start the next one; extra entries (numbers or 0-d tensors,
+        read back here) are added to the summary.
+        """
+        if not self.enabled:
+            return
+        extra = {name: value.item() if torch.is_tensor(value) else value for name, value in extra.items()}
+        summary = dict({'step': step, 'time': time.time() - self.step_start,
+                        'phases': self.phases}, **dict(self.step_memory(), **extra))
+        self.output.write(json.dumps(summary) + '\n')
+        self.output.flush()
+
+        if self.trace_dir is not None:
+            if step + 1 == self.trace_steps[0]:
+                self.start_trace()
+            elif step + 1 == self.trace_steps[1] and self.trace is not None:
+                self.stop_trace()
+        self.reset()
+
+    def start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(activities = activities, profile_memory = True)
+        self.trace.start()
+
+    def stop_trace(self):
+        self.trace.stop()
+        path = os.path.join(self.trace_dir, 'trace_steps_{}-{}.json'.format(*self.trace_steps))
+        self.trace.export_chrome_trace(path)
+        self.trace = None
+        log(STEP, 'profile_trace', path = path, first = self.trace_steps[0], last = self.trace_steps[1] - 1)
+
+    def close(self):
+        if self.trace is not None:
+            self.stop_trace()
+        if self.output is not None and self.output is not sys.stdout:
+            self.output.close()
+
+
+profiler = PhaseProfiler()
+
+
+def phase(name):
+    return profiler.phase(name)
+
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as phase name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -3,23 +3,42 @@ from torch.nn import functional as F
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler
 from torch.optim import Adam
 from torch.nn import CrossEntropyLoss
-from transformers import BertForSequenceClassification
+from fast_startup import load_pretrained
 from copy import deepcopy
-import gc
-from sklearn.metrics import accuracy_score
 import torch
 import numpy as np
+from batching import support_dataloader, trim_batch
+from distributed import broadcast_parameters, all_reduce_, mean_over_ranks
+from flat_params import flat_buffer, flat_views
+from precision import autocast
+from metrics import accuracy
+from early_stopping import InnerLoopStopper, grad_norm
+from profiling import phase
+from metrics_sink import log, enabled, TASK, INNER
 
 class Learner(nn.Module):
     """
     Meta Learner
+
+    The outer step moves the meta weights towards the mean of the adapted weights, either with Adam
+    along the mean of meta - fast (args.reptile_update == 'adam') or by plain interpolation with
+    step size args.reptile_epsilon ('interpolate').
+
+    With args.bf16 the forward passes of the inner steps and of the query run under bf16 autocast,
+    weights, gradients and the delta accumulator stay fp32.
     """
     def __init__(self, args):
         """
         :param args:
         """
         super(Learner, self).__init__()
-        
+
+        # options of maml.Learner and maml_functional.Learner that are not implemented here
+        unsupported = [name for name in ('freeze_depth', 'second_order', 'second_order_horizon',
+                                         'checkpoint_activations') if getattr(args, name, None)]
+        if unsupported:
+            raise ValueError("--learner reptile does not support --{}".format(', --'.join(unsupported)))
+
         self.num_labels = args.num_labels
         self.outer_batch_size = args.outer_batch_size
         self.inner_batch_size = args.inner_batch_size
@@ -28,14 +47,64 @@ class Learner(nn.Module):
         self.inner_update_step = args.inner_update_step
         self.inner_update_step_eval = args.inner_update_step_eval
         self.bert_model = args.bert_model
+        self.dynamic_padding  = args.dynamic_padding
+        self.length_bucketing = args.length_bucketing
+        self.reptile_update   = args.reptile_update
+        self.reptile_epsilon  = args.reptile_epsilon
+        self.bf16             = args.bf16
+        self.query_chunk_size = args.query_chunk_size
+        self.stopper = InnerLoopStopper(args.inner_loss_tolerance, args.inner_grad_norm)
+        # inner epochs run for every task of the last forward call
+        self.inner_steps_used = []
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if args.local_rank != -1 and torch.cuda.is_available():
+            self.device = torch.device('cuda', args.local_rank)
         
-        self.model = BertForSequenceClassification.from_pretrained(self.bert_model, num_labels = self.num_labels)
+        self.model = load_pretrained(self.bert_model, self.num_labels, args.weights_cache)
+        broadcast_parameters(self.model)
         self.outer_optimizer = Adam(self.model.parameters(), lr=self.outer_update_lr)
         self.model.train()
 
+        # Allocated once, reset in place from the meta weights for every task
+        self.fast_model = deepcopy(self.model).to(self.device)
+        self.inner_optimizer = Adam(self.fast_model.parameters(), lr=self.inner_update_lr)
+
+        # Task deltas (meta - adapted weights) are summed, without autograd, into one flat buffer on the
+        # compute device, copied once to the host when the meta model lives elsewhere. The deltas are
+        # taken against a device copy of the meta weights, refreshed once per outer step.
+        meta_params = list(self.model.parameters())
+        self.meta_delta = flat_buffer(meta_params, device=self.device)
+        self.meta_delta_views = flat_views(self.meta_delta, meta_params)
+        if meta_params[0].device == self.device:
+            self.meta_delta_host = self.meta_delta
+            self.meta_copy_views = meta_params
+        else:
+            self.meta_delta_host = flat_buffer(meta_params).pin_memory()
+            self.meta_copy_views = flat_views(flat_buffer(meta_params, device=self.device), meta_params)
+        self.meta_delta_host_views = flat_views(self.meta_delta_host, meta_params)
+
+    def reset_fast_model(self):
+        """
+        Copy the meta weights into the fast model and zero the inner optimizer state,
+        which is the state of a newly created Adam.
+        """
+        with torch.no_grad():
+            for fast, meta in zip(self.fast_model.state_dict().values(), self.model.state_dict().values()):
+                fast.copy_(meta)
+        for state in self.inner_optimizer.state.values():
+            for key, value in state.items():
+                if torch.is_tensor(value):
+                    value.zero_()
+                else:
+                    state[key] = 0
+        self.inner_optimizer.zero_grad(set_to_none=False)
+
     def forward(self, batch_tasks, training = True):
         """
+        In distributed mode batch_tasks is the share of the outer batch of this rank (possibly empty),
+        the meta-gradient and the returned accuracy are averaged over the tasks of all ranks.
+        The mean query accuracy is returned as a 0-d tensor, left on the device.
+
         batch = [(support TensorDataset, query TensorDataset),
                  (support TensorDataset, query TensorDataset),
                  (support TensorDataset, query TensorDataset),
@@ -44,89 +113,118 @@ class Learner(nn.Module):
         # support = TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)
         """
         task_accs = []
-        sum_gradients = []
-        num_task = len(batch_tasks)
         num_inner_update_step = self.inner_update_step if training else self.inner_update_step_eval
+        self.inner_steps_used = []
+
+        if training and self.meta_copy_views[0] is not next(self.model.parameters()):
+            with phase('meta_copy'), torch.no_grad():
+                for meta_copy, params in zip(self.meta_copy_views, self.model.parameters()):
+                    meta_copy.copy_(params)
 
         for task_id, task in enumerate(batch_tasks):
             support = task[0]
             query   = task[1]
             
-            fast_model = deepcopy(self.model)
-            fast_model.to(self.device)
-            support_dataloader = DataLoader(support, sampler=RandomSampler(support),
-                                            batch_size=self.inner_batch_size)
+            with phase('reset_fast_model'):
+                self.reset_fast_model()
+            fast_model = self.fast_model
+            inner_optimizer = self.inner_optimizer
+            support_loader = support_dataloader(support, self.inner_batch_size, self.length_bucketing)
             
-            inner_optimizer = Adam(fast_model.parameters(), lr=self.inner_update_lr)
             fast_model.train()
             
-            print('----Task',task_id, '----')
+            inner_tokens, fixed_tokens = 0, 0
+            self.stopper.reset()
+            inner_epochs = 0
             for i in range(0,num_inner_update_step):
-                all_loss = []
-                for inner_step, batch in enumerate(support_dataloader):
+                inner_epochs += 1
+                all_loss, all_grad_norm = [], []
+                for inner_step, batch in enumerate(support_loader):
                     
-                    batch = tuple(t.to(self.device) for t in batch)
+                    fixed_tokens += batch[0].numel()
+                    if self.dynamic_padding:
+                        batch = trim_batch(batch)
+                    inner_tokens += batch[0].numel()
+                    with phase('to_device'):
+                        batch = tuple(t.to(self.device) for t in batch)
                     input_ids, attention_mask, segment_ids, label_id = batch
-                    outputs = fast_model(input_ids, attention_mask, segment_ids, labels = label_id)
+                    with phase('inner_forward'), autocast(self.device, self.bf16):
+                        outputs = fast_model(input_ids, attention_mask, segment_ids, labels = label_id)
                     
                     loss = outputs[0]              
-                    loss.backward()
-                    inner_optimizer.step()
-                    inner_optimizer.zero_grad()
+                    with phase('inner_backward'):
+                        loss.backward()
+                    if self.stopper.grad_norm_threshold > 0:
+                        all_grad_norm.append(grad_norm(inner_optimizer.param_groups[0]['params']))
+                    with phase('inner_step'):
+                        inner_optimizer.step()
+                        inner_optimizer.zero_grad(set_to_none=False)
                     
-                    all_loss.append(loss.item())
+                    all_loss.append(loss.detach())
                 
-                if i % 4 == 0:
-                    print("Inner Loss: ", np.mean(all_loss))
-            
-            fast_model.to(torch.device('cpu'))
+                if enabled(INNER):
+                    log(INNER, 'inner_loss', task = task_id, epoch = i, loss = torch.stack(all_loss).mean())
+
+                if self.stopper.enabled and self.stopper.converged(all_loss, all_grad_norm):
+                    break
+
+            self.inner_steps_used.append(inner_epochs)
+            if enabled(TASK):
+                record = {'task': task_id, 'inner_steps': inner_epochs}
+                if self.dynamic_padding:
+                    # inner tokens per step, trimmed and with fixed padding
+                    record['inner_tokens'] = inner_tokens / float(inner_epochs * len(support_loader))
+                    record['fixed_tokens'] = fixed_tokens / float(inner_epochs * len(support_loader))
+                log(TASK, 'task', **record)
             
             if training:
-                meta_weights = list(self.model.parameters())
-                fast_weights = list(fast_model.parameters())
-
-                gradients = []
-                for i, (meta_params, fast_params) in enumerate(zip(meta_weights, fast_weights)):
-                    gradient = meta_params - fast_params
-                    if task_id == 0:
-                        sum_gradients.append(gradient)
-                    else:
-                        sum_gradients[i] += gradient
-
-            fast_model.to(self.device)
+                with phase('meta_delta'), torch.no_grad():
+                    for meta_delta, meta_params, fast_params in zip(self.meta_delta_views, self.meta_copy_views,
+                                                                    fast_model.parameters()):
+                        # in place, without a temporary per parameter
+                        meta_delta.add_(meta_params).sub_(fast_params)
+
             fast_model.eval()
-            with torch.no_grad():
-                query_dataloader = DataLoader(query, sampler=None, batch_size=len(query))
-                query_batch = iter(query_dataloader).next()
-                query_batch = tuple(t.to(self.device) for t in query_batch)
-                q_input_ids, q_attention_mask, q_segment_ids, q_label_id = query_batch
-                q_outputs = fast_model(q_input_ids, q_attention_mask, q_segment_ids, labels = q_label_id)
-
-                q_logits = F.softmax(q_outputs[1],dim=1)
-                pre_label_id = torch.argmax(q_logits,dim=1)
-                pre_label_id = pre_label_id.detach().cpu().numpy().tolist()
-                q_label_id = q_label_id.detach().cpu().numpy().tolist()
-
-                acc = accuracy_score(pre_label_id,q_label_id)
-                task_accs.append(acc)
-            
-            fast_model.to(torch.device('cpu'))
-            del fast_model, inner_optimizer
-            torch.cuda.empty_cache()
+            with phase('query_forward'), torch.no_grad():
+                # query pass in chunks of query_chunk_size examples
+                all_q_logits, all_q_label_id = [], []
+                query_dataloader = DataLoader(query, sampler=None, batch_size=self.query_chunk_size or len(query))
+                for query_batch in query_dataloader:
+                    if self.dynamic_padding:
+                        query_batch = trim_batch(query_batch)
+                    query_batch = tuple(t.to(self.device) for t in query_batch)
+                    q_input_ids, q_attention_mask, q_segment_ids, q_label_id = query_batch
+                    with autocast(self.device, self.bf16):
+                        q_outputs = fast_model(q_input_ids, q_attention_mask, q_segment_ids, labels = q_label_id)
+                    all_q_logits.append(q_outputs[1])
+                    all_q_label_id.append(q_label_id)
+
+                # kept on the device, read back once for all tasks
+                task_accs.append(accuracy(torch.cat(all_q_logits), torch.cat(all_q_label_id)))
         
+        # Mean accuracy and task count over ranks, the accuracy is left on the device
+        acc, num_task = mean_over_ranks(task_accs)
+
         if training:
-            # Average gradient across tasks
-            for i in range(0,len(sum_gradients)):
-                sum_gradients[i] = sum_gradients[i] / float(num_task)
+            with phase('outer_update'):
+                # Sum over ranks (a rank without task adds zeros), then average the deltas across tasks
+                all_reduce_(self.meta_delta)
+                if self.meta_delta_host is not self.meta_delta:
+                    self.meta_delta_host.copy_(self.meta_delta)
+                self.meta_delta_host.div_(num_task)
 
-            #Assign gradient for original model, then using optimizer to update its weights
-            for i, params in enumerate(self.model.parameters()):
-                params.grad = sum_gradients[i]
+                if self.reptile_update == 'interpolate':
+                    # meta <- meta + epsilon * mean (fast - meta)
+                    with torch.no_grad():
+                        for params, meta_delta in zip(self.model.parameters(), self.meta_delta_host_views):
+                            params.sub_(meta_delta, alpha=self.reptile_epsilon)
+                else:
+                    #Assign the mean delta as gradient of the original model, then using optimizer to update its weights
+                    for params, meta_delta in zip(self.model.parameters(), self.meta_delta_host_views):
+                        params.grad = meta_delta
 
-            self.outer_optimizer.step()
-            self.outer_optimizer.zero_grad()
-            
-            del sum_gradients
-            gc.collect()
+                    self.outer_optimizer.step()
+                    self.outer_optimizer.zero_grad()
+                self.meta_delta.zero_()
         
-        return np.mean(task_accs)
\ No newline at end of file
+        return acc
\ No newline at end of file
@@ -1,75 +1,135 @@
 import os
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import numpy as np
 import collections
 import random
+import itertools
 import json, pickle
 from torch.utils.data import TensorDataset
+from token_cache import batch_encode
+from profiling import profiled
 
 LABEL_MAP  = {'positive':0, 'negative':1, 0:'positive', 1:'negative'}
 
+class DomainIndex(object):
+    """
+    Domain -> example index lookup, built once per dataset and shared by every MetaTask
+    drawn from it. Indices of each domain are stored contiguously (CSR layout):
+    members of domain d are order[offsets[d]:offsets[d+1]].
+    """
+    def __init__(self, examples):
+        """
+        :param examples: list of samples, each with a 'domain' field
+        """
+        domains = np.array([e['domain'] for e in examples])
+        self.domains, inverse, self.counts = np.unique(domains, return_inverse=True, return_counts=True)
+        self.order   = np.argsort(inverse, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def members(self, domain_id):
+        return self.order[self.offsets[domain_id]:self.offsets[domain_id + 1]]
+
+    def __len__(self):
+        return len(self.domains)
+
+
+@profiled('sample_tasks')
+def sample_task_indices(domain_index, num_task, k, rng):
+    """
+    Draw num_task sets of k examples, each set from a single domain, in one vectorized pass.
+    Domains are picked proportionally to their size, i.e. the same distribution as
+    picking the domain of a uniformly random example.
+    :param domain_index: DomainIndex of the dataset
+    :param num_task: number of tasks to draw
+    :param k: examples per task (k_support + k_query)
+    :param rng: numpy Generator
+    :return: (num_task, k) array of example indices
+    """
+    probs = domain_index.counts / domain_index.counts.sum()
+    task_domains = rng.choice(len(domain_index), size=num_task, p=probs)
+    selected = np.empty((num_task, k), dtype=np.int64)
+
+    for domain_id in np.unique(task_domains):
+        rows = np.flatnonzero(task_domains == domain_id)
+        size = domain_index.counts[domain_id]
+        if size < k:
+            raise ValueError("Domain {} has {} examples, fewer than the {} needed per task".format(
+                             domain_index.domains[domain_id], size, k))
+
+        # Draw with replacement and redraw the (rare, when size >> k) rows containing a duplicate.
+        # Draws are i.i.d., so the order within a row is already a random permutation.
+        draws = rng.integers(0, size, size=(len(rows), k))
+        sorted_draws = np.sort(draws, axis=1)
+        for r in np.flatnonzero((sorted_draws[:, 1:] == sorted_draws[:, :-1]).any(axis=1)):
+            draws[r] = rng.choice(size, size=k, replace=False)
+
+        selected[rows] = domain_index.members(domain_id)[draws]
+    return selected
+
+
+@profiled('create_feature_set')
+def create_feature_set(examples, tokenizer, max_seq_length, token_cache=None):
+    """
+    TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids) of a list of reviews
+    """
+    texts = [example['text'] for example in examples]
+    all_ids = batch_encode(tokenizer, texts) if token_cache is None else token_cache.encode_batch(tokenizer, texts)
+
+    # truncate over-length reviews to max_seq_length, keeping the final [SEP]
+    all_ids = [ids if len(ids) <= max_seq_length
+               else np.concatenate([ids[:max_seq_length - 1], ids[-1:]]) for ids in all_ids]
+    lengths = np.array([len(ids) for ids in all_ids], dtype=np.int64)
+
+    # scatter all ids into the zero-padded matrix at once
+    rows = np.repeat(np.arange(len(examples)), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    all_input_ids = torch.zeros(len(examples), max_seq_length, dtype = torch.long)
+    all_input_ids[torch.from_numpy(rows), torch.from_numpy(cols)] = torch.from_numpy(
+        np.concatenate(all_ids).astype(np.int64))
+
+    all_attention_mask = (torch.arange(max_seq_length)[None, :] < torch.from_numpy(lengths)[:, None]).long()
+    all_segment_ids    = torch.zeros(len(examples), max_seq_length, dtype = torch.long)
+    all_label_ids      = torch.tensor([LABEL_MAP[example['label']] for example in examples], dtype = torch.long)
+
+    tensor_set = TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)  
+    return tensor_set
+
+
 class MetaTask(Dataset):
     
-    def __init__(self, examples, num_task, k_support, k_query, tokenizer):
+    def __init__(self, examples, num_task, k_support, k_query, tokenizer, domain_index=None, seed=None,
+                 token_cache=None):
         """
         :param samples: list of samples
         :param num_task: number of training tasks.
         :param k_support: number of support sample per task
         :param k_query: number of query sample per task
+        :param domain_index: prebuilt DomainIndex of examples, built here if not given
+        :param seed: seed of the task sampler, tasks are reproducible for a given seed
+        :param token_cache: TokenCache shared across MetaTasks, None to tokenize on every fetch
         """
         self.examples = examples
-        random.shuffle(self.examples)
+        self.domain_index = domain_index if domain_index is not None else DomainIndex(examples)
         
         self.num_task = num_task
         self.k_support = k_support
         self.k_query = k_query
         self.tokenizer = tokenizer
+        self.token_cache = token_cache
         self.max_seq_length = 256
+        self.rng = np.random.default_rng(seed)
         self.create_batch(self.num_task)
     
     def create_batch(self, num_task):
-        self.supports = []  # support set
-        self.queries = []  # query set
-        
-        for b in range(num_task):  # for each task
-            # 1.select domain randomly
-            domain = random.choice(self.examples)['domain']
-            domainExamples = [e for e in self.examples if e['domain'] == domain]
-            
-            # 1.select k_support + k_query examples from domain randomly
-            selected_examples = random.sample(domainExamples,self.k_support + self.k_query)
-            random.shuffle(selected_examples)
-            exam_train = selected_examples[:self.k_support]
-            exam_test  = selected_examples[self.k_support:]
-            
-            self.supports.append(exam_train)
-            self.queries.append(exam_test)
+        # select a domain per task, then k_support + k_query examples from it, for all tasks at once
+        selected = sample_task_indices(self.domain_index, num_task, self.k_support + self.k_query, self.rng)
+
+        self.supports = [[self.examples[i] for i in row[:self.k_support]] for row in selected]  # support set
+        self.queries  = [[self.examples[i] for i in row[self.k_support:]] for row in selected]  # query set
 
     def create_feature_set(self,examples):
-        all_input_ids      = torch.empty(len(examples), self.max_seq_length, dtype = torch.long)
-        all_attention_mask = torch.empty(len(examples), self.max_seq_length, dtype = torch.long)
-        all_segment_ids    = torch.empty(len(examples), self.max_seq_length, dtype = torch.long)
-        all_label_ids      = torch.empty(len(examples), dtype = torch.long)
-
-        for id_,example in enumerate(examples):
-            input_ids = self.tokenizer.encode(example['text'])
-            attention_mask = [1] * len(input_ids)
-            segment_ids    = [0] * len(input_ids)
-
-            while len(input_ids) < self.max_seq_length:
-                input_ids.append(0)
-                attention_mask.append(0)
-                segment_ids.append(0)
-
-            label_id = LABEL_MAP[example['label']]
-            all_input_ids[id_] = torch.Tensor(input_ids).to(torch.long)
-            all_attention_mask[id_] = torch.Tensor(attention_mask).to(torch.long)
-            all_segment_ids[id_] = torch.Tensor(segment_ids).to(torch.long)
-            all_label_ids[id_] = torch.Tensor([label_id]).to(torch.long)
-
-        tensor_set = TensorDataset(all_input_ids, all_attention_mask, all_segment_ids, all_label_ids)  
-        return tensor_set
+        return create_feature_set(examples, self.tokenizer, self.max_seq_length, self.token_cache)
     
     def __getitem__(self, index):
         support_set = self.create_feature_set(self.supports[index])
@@ -78,4 +138,76 @@ class MetaTask(Dataset):
 
     def __len__(self):
         # as we have built up to batchsz of sets, you can sample some small batch size of sets.
-        return self.num_task
\ No newline at end of file
+        return self.num_task
+
+
+class TaskStream(IterableDataset):
+    """
+    Unbounded stream of outer batches of freshly sampled tasks, replacing the per-epoch MetaTask rebuilds.
+
+    Tasks are drawn lazily in blocks of block_size with sample_task_indices, block b seeded by (seed, b),
+    so task i only depends on seed and i: the stream starts in O(1), keeps no task beyond the current
+    block, and resumes the same task sequence from a saved position (number of outer batches consumed).
+    """
+    def __init__(self, examples, k_support, k_query, tokenizer, batch_size, domain_index=None, seed=0,
+                 token_cache=None, block_size=256, rank=0, world_size=1):
+        """
+        :param samples: list of samples
+        :param k_support: number of support sample per task
+        :param k_query: number of query sample per task
+        :param batch_size: number of tasks per outer batch
+        :param domain_index: prebuilt DomainIndex of examples, built here if not given
+        :param seed: seed of the task sampler
+        :param token_cache: TokenCache, None to tokenize on every fetch
+        :param block_size: number of tasks sampled together
+        :param rank, world_size: in distributed mode, every rank yields its share of each outer batch
+        """
+        self.examples = examples
+        self.domain_index = domain_index if domain_index is not None else DomainIndex(examples)
+        self.k_support = k_support
+        self.k_query = k_query
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.seed = seed
+        self.token_cache = token_cache
+        self.block_size = block_size
+        self.rank = rank
+        self.world_size = world_size
+        self.max_seq_length = 256
+        self.position = 0
+        self.block = (None, None)
+
+    def selection(self, task_id):
+        block_id, offset = divmod(task_id, self.block_size)
+        if self.block[0] != block_id:
+            rng = np.random.default_rng([self.seed, block_id])
+            self.block = (block_id, sample_task_indices(self.domain_index, self.block_size,
+                                                        self.k_support + self.k_query, rng))
+        return self.block[1][offset]
+
+    def task(self, task_id):
+        selected = self.selection(task_id)
+        support_set = create_feature_set([self.examples[i] for i in selected[:self.k_support]],
+                                         self.tokenizer, self.max_seq_length, self.token_cache)
+        query_set   = create_feature_set([self.examples[i] for i in selected[self.k_support:]],
+                                         self.tokenizer, self.max_seq_length, self.token_cache)
+        return support_set, query_set
+
+    def batch(self, position):
+        first = position * self.batch_size
+        return [self.task(i) for i in range(first, first + self.batch_size)[self.rank::self.world_size]]
+
+    def __iter__(self):
+        # DataLoader workers take every num_workers-th batch, which the DataLoader yields back in order
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        for position in itertools.count(self.position + worker_id, num_workers):
+            yield self.batch(position)
+
+    def state_dict(self):
+        return {'seed': self.seed, 'position': self.position}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.position = state['position']
+        self.block = (None, None)
@@ -27,6 +27,8 @@ from transformers import glue_processors as processors
 from transformers import glue_output_modes as output_modes
 from transformers import glue_convert_examples_to_features as convert_examples_to_features
 import logging
+from profiling import profiled
+from glue_store import open_feature_store
 
 ## TODO: 
 ## 1. in arguments add 'data_dir, model_name_or_path (removed), max_seq_length, local_rank' done
@@ -78,9 +80,11 @@ class MetaTask(Dataset):
         self.data_dir        = args.data_dir
         self.bert_model      = args.bert_model
         self.overwrite_cache = args.overwrite_cache
+        self.feature_store   = getattr(args, 'feature_store', None)
 
         self.create_batch(self.num_task)
 
+    @profiled('create_batch')
     def create_batch(self, num_task):
         '''
         Randomly select number of examples from each task into supports (meta training dataset) and queries (meta evaluating dataset)
@@ -103,6 +107,7 @@ class MetaTask(Dataset):
             self.supports.append(exam_train)
             self.queries.append(exam_test)
 
+    @profiled('load_examples')
     def load_and_cache_examples(self, task, tokenizer, evaluate=False):
         '''
         Copied from official loading and cache scripts from Huggingface Transformer load_and_cache_examples
@@ -114,6 +119,10 @@ class MetaTask(Dataset):
         else:
             task_data_path = task.upper()
 
+        if self.feature_store is not None:
+            store = open_feature_store(self.feature_store, task, self.max_seq_length, evaluate)
+            if store is not None:
+                return store.sample(self.k_support + self.k_query)
 
         if self.local_rank not in [-1, 0] and not evaluate:
             torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
@@ -27,6 +27,9 @@ from transformers import glue_processors as processors
 from transformers import glue_output_modes as output_modes
 from transformers import glue_convert_examples_to_features as convert_examples_to_features
 import logging
+from profiling import profiled
+from glue_store import open_feature_store
+from glue_stream import stream_sample_examples
 
 # NOTE: Before running this script, please makes sure all 8 GLUE datasets are downloaded 
 # in local by running python3 ../../utils/download_glue_data.py under transformers directory
@@ -82,9 +85,12 @@ class MetaTask(Dataset):
         self.data_dir        = args.data_dir
         self.bert_model      = args.bert_model
         self.overwrite_cache = args.overwrite_cache
+        self.feature_store   = getattr(args, 'feature_store', None)
+        self.stream_examples = getattr(args, 'stream_examples', False)
 
         self.create_batch(self.num_task)
 
+    @profiled('create_batch')
     def create_batch(self, num_task):
         '''
         Randomly select number of examples from each task into supports (meta training dataset) and queries (meta evaluating dataset)
@@ -92,7 +98,7 @@ class MetaTask(Dataset):
         self.supports = []  # support set
         self.queries = []  # query set
         # 1. randomly select num_task GLUE tasks 
-        if len(processors.keys) < num_task:
+        if len(processors.keys()) < num_task:
             logger.info('Num of tasks exceed avaliable tasks, drawing tasks with replacement')
             tasks = random.choices(list(processors.keys()), k = num_task)
         else:
@@ -111,6 +117,7 @@ class MetaTask(Dataset):
             self.supports.append(exam_train)
             self.queries.append(exam_test)
 
+    @profiled('load_examples')
     def load_and_cache_examples(self, task, tokenizer, evaluate=False):
         '''
         Heavily insipired from official loading and cache scripts from Huggingface Transformer func load_and_cache_examples
@@ -122,6 +129,10 @@ class MetaTask(Dataset):
         else:
             task_data_path = task.upper()
 
+        if self.feature_store is not None:
+            store = open_feature_store(self.feature_store, task, self.max_seq_length, evaluate)
+            if store is not None:
+                return store.sample(self.k_support + self.k_query)
 
         if self.local_rank not in [-1, 0] and not evaluate:
             torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
@@ -134,14 +145,18 @@ class MetaTask(Dataset):
         logger.info(f"Creating {self.k_support+self.k_query} features from dataset file at {cached_downloaded_file}")
         label_list = processor.get_labels()
 
-        examples = (
-                processor.get_dev_examples(cached_downloaded_file) if evaluate else processor.get_train_examples(cached_downloaded_file)
-            )
-
-        if len(selected_examples) < self.k_query + self.k_support:
-            selected_examples = random.choices(examples, k = self.k_support + self.k_query)
+        if self.stream_examples:
+            # reservoir-sample the rows while reading the TSV, never materializing the whole split
+            selected_examples = stream_sample_examples(task, self.data_dir, self.k_support + self.k_query, evaluate)
         else:
-            selected_examples = random.sample(examples, self.k_support + self.k_query)
+            examples = (
+                    processor.get_dev_examples(cached_downloaded_file) if evaluate else processor.get_train_examples(cached_downloaded_file)
+                )
+
+            if len(examples) < self.k_query + self.k_support:
+                selected_examples = random.choices(examples, k = self.k_support + self.k_query)
+            else:
+                selected_examples = random.sample(examples, self.k_support + self.k_query)
 
         features = convert_examples_to_features(
             selected_examples, tokenizer, max_length=self.max_seq_length, label_list=label_list, output_mode=output_mode,
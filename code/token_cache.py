@@ -0,0 +1,128 @@
+import os
+import hashlib
+import pickle
+from collections import OrderedDict
+import numpy as np
+
+
+def batch_encode(tokenizer, texts):
+    """
+    Tokenize a list of texts in one call when the tokenizer supports it (fast tokenizers
+    run the whole batch in native code), falling back to encoding one text at a time.
+    """
+    if hasattr(tokenizer, 'batch_encode_plus'):
+        return tokenizer.batch_encode_plus(texts)['input_ids']
+    return [tokenizer.encode(text) for text in texts]
+
+
+class TokenCache(object):
+    """
+    Content-keyed cache of token ids, shared across epochs and persisted across runs.
+
+    Entries are keyed by the sha1 digest of the text and stored as compact int32 arrays.
+    The cache holds at most max_entries texts, the least recently used entry is evicted first.
+    """
+    def __init__(self, path=None, max_entries=1000000, namespace=''):
+        """
+        :param path: pickle file the cache is loaded from and saved to, None for an in-memory cache
+        :param max_entries: maximum number of cached texts
+        :param namespace: identifies the tokenizer (e.g. bert model name), a cache file written
+                          under another namespace is discarded
+        """
+        self.path        = path
+        self.max_entries = max_entries
+        self.namespace   = namespace
+        self.entries     = OrderedDict()
+        self.dirty       = False
+        self.pending     = None
+        self.hits        = 0
+        self.misses      = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).digest()
+
+    def get(self, text):
+        key = self.key(text)
+        ids = self.entries.get(key)
+        if ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return ids
+
+    def put(self, text, ids):
+        key = self.key(text)
+        self.entries[key] = np.asarray(ids, dtype=np.int32)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+        if self.pending is not None:
+            self.pending[key] = self.entries[key]
+
+    def subset(self, texts):
+        """
+        In-memory TokenCache holding the cached entries of texts only (for worker processes)
+        """
+        subset = TokenCache(max_entries=self.max_entries, namespace=self.namespace)
+        for text in texts:
+            key = self.key(text)
+            if key in self.entries:
+                subset.entries[key] = self.entries[key]
+        return subset
+
+    def take_pending(self):
+        """
+        Entries put since the last call, recorded once pending is set to a dict
+        """
+        pending, self.pending = self.pending, OrderedDict()
+        return pending
+
+    def merge(self, entries):
+        """
+        Add the entries of take_pending of another cache
+        """
+        for key, ids in entries.items():
+            self.entries[key] = ids
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = self.dirty or len(entries) > 0
+
+    def encode_batch(self, tokenizer, texts):
+        """
+        Token ids of every text, the cache misses are tokenized together in one batched call.
+        """
+        all_ids = [self.get(text) for text in texts]
+        missing = [i for i, ids in enumerate(all_ids) if ids is None]
+        if missing:
+            encoded = batch_encode(tokenizer, [texts[i] for i in missing])
+            for i, ids in zip(missing, encoded):
+                all_ids[i] = np.asarray(ids, dtype=np.int32)
+                self.put(texts[i], all_ids[i])
+        return all_ids
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if state['namespace'] != self.namespace:
+            return
+        self.entries = state['entries']
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'namespace': self.namespace, 'entries': self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.entries)